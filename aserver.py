@@ -0,0 +1,249 @@
+'''
+Asyncio mode of server.py, for fleets of thousands of client.py instances.
+Copyright (C) 2023, Mo Zhou <lumin@debian.org>
+MIT/Expat License
+
+All the connections are served by one event loop, without a thread per
+request. The submissions are decoded by the connection handlers (large
+bodies in worker threads), and applied to the state of server.py by a
+single task in arrival order. The dashboard and the other routes are the
+ones of server.py, rendered from the same state.
+
+Usage
+=====
+
+At the server side: `$ python3 aserver.py -P 4222`
+The load generator in bench.py can be pointed at it: `$ python3 bench.py load`
+'''
+import io
+import sys
+import time
+import json
+import asyncio
+import argparse
+import http
+from urllib.parse import unquote_to_bytes
+from werkzeug.datastructures import Headers
+import server
+from server import console
+
+# bodies larger than this are decoded in a worker thread
+__DECODE_INLINE_MAX__ = 64 * 1024
+# larger bodies are rejected
+__BODY_MAX__ = 64 * 1024 * 1024
+# submissions waiting to be applied, bounded for backpressure
+__QUEUE__ = None
+# set (and cleared) after each applied submission, wakes up /events
+__CHANGED__ = None
+
+
+async def apply_loop() -> None:
+    '''
+    the only place where the submissions are applied to the state
+    '''
+    while True:
+        (apply, data, future) = await __QUEUE__.get()
+        try:
+            future.set_result(apply(data))
+        except Exception as e:
+            future.set_exception(e)
+        __CHANGED__.set()
+        __CHANGED__.clear()
+
+
+async def submit(path: str, body: bytes, headers: Headers) -> tuple:
+    loop = asyncio.get_running_loop()
+    try:
+        if len(body) > __DECODE_INLINE_MAX__:
+            data = await loop.run_in_executor(None, server.decode_payload, body, headers)
+        else:
+            data = server.decode_payload(body, headers)
+    except Exception as e:
+        console.log(f'malformed POST body: {e!r}')
+        return 400, [], b'malformed POST body'
+    if data is None:
+        return 415, [], b'unsupported POST content type'
+    future = loop.create_future()
+    apply = server.apply_submit if path == '/submit' else server.apply_batch
+    await __QUEUE__.put((apply, data, future))
+    response, status = await future
+    return (status, [('Content-Type', 'application/json')],
+            json.dumps(response, separators=(',', ':')).encode())
+
+
+def call_wsgi(method: str, target: str, headers: Headers, body: bytes,
+              sockname: tuple, peername: tuple) -> tuple:
+    '''
+    serve a request with the flask app of server.py
+    '''
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': str(sockname[0]),
+        'SERVER_PORT': str(sockname[1]),
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': str(peername[0]) if peername else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        }
+    for (k, v) in headers.items():
+        k = k.upper().replace('-', '_')
+        if k in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[k] = v
+        else:
+            environ[f'HTTP_{k}'] = v
+    status_headers = []
+    def start_response(status, response_headers, exc_info=None):
+        status_headers[:] = [status, response_headers]
+    result = server.app.wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    status, response_headers = status_headers
+    response_headers = [(k, v) for (k, v) in response_headers
+                        if k.lower() != 'content-length']
+    return int(status.split()[0]), response_headers, body
+
+
+def write_response(writer, status: int, headers: list, body: bytes,
+                   keep_alive: bool) -> None:
+    head = [f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}']
+    head.extend(f'{k}: {v}' for (k, v) in headers)
+    head.append(f'Content-Length: {len(body)}')
+    head.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+
+async def stream_events(writer, headers: Headers) -> None:
+    '''
+    Server-Sent Events stream of host updates, as /events of server.py
+    '''
+    events = server.__EVENTS__
+    seq = headers.get('Last-Event-ID', default=events.seq, type=int)
+    writer.write(b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: text/event-stream\r\n'
+                 b'Cache-Control: no-cache\r\n'
+                 b'X-Accel-Buffering: no\r\n'
+                 b'Connection: close\r\n\r\n'
+                 b'retry: 3000\n\n')
+    events.subscribe(+1)
+    try:
+        while True:
+            pending = events.since(seq)
+            if pending is None:
+                # too far behind, let the browser reload the page
+                writer.write(b'event: reload\ndata: {}\n\n')
+                await writer.drain()
+                return
+            if not pending:
+                try:
+                    await asyncio.wait_for(__CHANGED__.wait(), timeout=15.0)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+            for (seq, data) in pending:
+                writer.write(f'id: {seq}\ndata: {data}\n\n'.encode())
+            await writer.drain()
+    finally:
+        events.subscribe(-1)
+
+
+async def handle(reader, writer) -> None:
+    '''
+    serve the HTTP/1.1 requests of one connection
+    '''
+    sockname = writer.get_extra_info('sockname')
+    peername = writer.get_extra_info('peername')
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ', 2)
+            headers = Headers()
+            for line in lines[1:]:
+                if line:
+                    k, _, v = line.partition(':')
+                    headers.add(k.strip(), v.strip())
+            keep_alive = version == 'HTTP/1.1' \
+                and headers.get('Connection', '').lower() != 'close'
+            length = headers.get('Content-Length', default=0, type=int)
+            if 'chunked' in headers.get('Transfer-Encoding', ''):
+                write_response(writer, 411, [], b'', False)
+                return
+            if length > __BODY_MAX__:
+                write_response(writer, 413, [], b'', False)
+                return
+            body = await reader.readexactly(length) if length else b''
+            path = target.partition('?')[0]
+            if method == 'GET' and path == '/events':
+                await stream_events(writer, headers)
+                return
+            try:
+                if method == 'POST' and path in ('/submit', '/submit_batch'):
+                    begin = time.perf_counter()
+                    status, response_headers, response = await submit(path, body, headers)
+                    server.__STATS__.observe_route(f'POST {path}', time.perf_counter() - begin,
+                                                   len(body), len(response))
+                elif path == '/api/internal/profile':
+                    # the sampler blocks its thread for the whole profile,
+                    # and must run beside the event loop to see it
+                    loop = asyncio.get_running_loop()
+                    status, response_headers, response = await loop.run_in_executor(
+                        None, call_wsgi, method, target, headers, body, sockname, peername)
+                else:
+                    status, response_headers, response = call_wsgi(
+                        method, target, headers, body, sockname, peername)
+            except Exception as e:
+                console.log(f'{method} {target}: {e!r}')
+                status, response_headers, response = 500, [], b''
+            write_response(writer, status, response_headers, response, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> None:
+    global __QUEUE__, __CHANGED__
+    __QUEUE__ = asyncio.Queue(maxsize=10000)
+    __CHANGED__ = asyncio.Event()
+    applier = asyncio.create_task(apply_loop())
+    listener = await asyncio.start_server(handle, host, port, backlog=4096)
+    console.log(f'serving on http://{host}:{port}')
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == '__main__':
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-H', '--host', type=str, default='0.0.0.0')
+    ag.add_argument('-P', '--port', type=int, default=4222)
+    ag.add_argument('--history-db', type=str, default=server.__HISTORY_DB__,
+                    help='history database, or empty to disable the history'
+                    ' (also set by the GPUWATCH_HISTORY_DB environment variable)')
+    ag.add_argument('--state', type=str, default=server.os.environ.get('GPUWATCH_STATE', 'memory'),
+                    help='records shared with other workers: memory, mmap:PATH or sqlite:PATH'
+                    ' (also set by the GPUWATCH_STATE environment variable)')
+    ag = ag.parse_args()
+    server.__HISTORY__ = server.HistoryStore(ag.history_db) if ag.history_db else None
+    server.__STATE__ = server.make_state(ag.state)
+
+    try:
+        asyncio.run(serve(ag.host, ag.port))
+    except KeyboardInterrupt:
+        pass
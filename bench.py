@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for server.py, client.py and gpuwatch.py on a synthetic fleet.
+Copyright (C) 2023, Mo Zhou <lumin@debian.org>
+MIT/Expat License
+
+No GPU is needed, all the data is generated.
+
+Usage
+=====
+
+  $ python3 bench.py wire -G 8 -U 4
+  $ python3 bench.py load -N 2000 --interval 5 --duration 60
+  $ python3 bench.py consistency -W 4 --state mmap:/dev/shm/gpuwatch.state
+  $ python3 bench.py ingest -N 500 --rounds 5
+  $ python3 bench.py race -T 8 -N 20
+  $ python3 bench.py suite -N 200 -G 8 -U 16 --json today.json --compare last.json
+'''
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import timeit
+
+
+def synthetic_payload(hostname: str, gpus: int = 8, users: int = 4,
+                      seed: int = 0) -> dict:
+    '''
+    return a submission shaped like gpustat_filtered() | psutil_stat()
+    of client.py, with random but plausible values
+    '''
+    rng = random.Random(f'{hostname}/{seed}')
+    model = rng.choice(('NVIDIA GeForce RTX 3090', 'NVIDIA GeForce RTX 4090',
+                        'NVIDIA A100-SXM4-80GB', 'NVIDIA H100 80GB HBM3'))
+    total = 81920 if model.startswith(('NVIDIA A100', 'NVIDIA H100')) else 24576
+    stat = {
+            'hostname': hostname,
+            'driver_version': '535.129.03',
+            'query_time': time.time(),
+            'gpus': [],
+            }
+    for index in range(gpus):
+        gpu_users = dict()
+        if rng.random() < 0.7:
+            for user in rng.sample(range(users), rng.randint(1, min(2, users))):
+                gpu_users[f'user{user}'] = rng.randint(500, total // 2)
+        used = sum(gpu_users.values())
+        stat['gpus'].append({
+            'index': index,
+            'name': model,
+            'utilization.gpu': rng.randint(30, 100) if gpu_users else 0,
+            'memory.used': used + 4,
+            'memory.total': total,
+            'users': gpu_users,
+            })
+    return stat | {
+            'cpu_percent': 100 * rng.random(),
+            'loadavg': (64 * rng.random(), 64 * rng.random(), 64 * rng.random()),
+            'vm_total_M': 515703.4,
+            'vm_available_M': 515703.4 * rng.random(),
+            'sample_latency_ms': 2 * rng.random(),
+            }
+
+
+def synthetic_fleet(hosts: int, gpus: int = 8, users: int = 4,
+                    seed: int = 0) -> list:
+    '''
+    return the submissions of a fleet of hosts, sharing a pool of users
+    '''
+    return [synthetic_payload(f'node{i:05d}', gpus, users, seed)
+            for i in range(hosts)]
+
+
+def synthetic_database(path: str, seconds: int, gpus: int = 8,
+                       users: int = 4) -> None:
+    '''
+    fill a gpuwatch.py database with one snapshot per minute over the
+    last given seconds
+    '''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import gpuwatch
+    conn = gpuwatch.__connect(path)
+    # the database is disposable, do not wait for the disk
+    conn.execute('''PRAGMA synchronous=OFF''')
+    now = int(time.time())
+    for stamp in range(now - seconds - now % 60, now, 60):
+        stat = synthetic_payload('node00000', gpus, users, seed=stamp)
+        for gpu in stat['gpus']:
+            gpu['nprocs'] = {user: 1 for user in gpu['users']}
+        gpuwatch.__insert_snapshot(conn, stamp, stat)
+    conn.close()
+
+
+def timed(fn) -> float:
+    '''
+    return the mean time of a call in microseconds
+    '''
+    number, elapsed = timeit.Timer(fn).autorange()
+    return 1e6 * elapsed / number
+
+
+def wire_formats() -> dict:
+    '''
+    the wire formats that can be benchmarked on this machine,
+    name -> (encode, decode)
+    '''
+    formats = {
+        'json': (lambda x: json.dumps(x).encode(),
+                 lambda b: json.loads(b)),
+        'gzip-json': (lambda x: gzip.compress(json.dumps(x).encode()),
+                      lambda b: json.loads(gzip.decompress(b))),
+        }
+    try:
+        import msgpack
+        formats['msgpack'] = (msgpack.packb, msgpack.unpackb)
+        formats['gzip-msgpack'] = (lambda x: gzip.compress(msgpack.packb(x)),
+                                   lambda b: msgpack.unpackb(gzip.decompress(b)))
+    except ImportError:
+        print('msgpack is not installed, skipping.')
+    try:
+        import cbor2
+        formats['cbor'] = (cbor2.dumps, cbor2.loads)
+    except ImportError:
+        print('cbor2 is not installed, skipping.')
+    return formats
+
+
+def main_wire(argv):
+    '''
+    Compare encode/decode cost and size of the /submit wire formats
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-G', '--gpus', type=int, default=8)
+    ag.add_argument('-U', '--users', type=int, default=4)
+    ag = ag.parse_args(argv)
+
+    payload = synthetic_payload('node000', ag.gpus, ag.users)
+    print(f':: wire formats, one submission of {ag.gpus} GPUs')
+    print(f'{"format":>14} {"bytes":>8} {"encode(us)":>11} {"decode(us)":>11}')
+    for (name, (encode, decode)) in wire_formats().items():
+        body = encode(payload)
+        enc = timed(lambda: encode(payload))
+        dec = timed(lambda: decode(body))
+        print(f'{name:>14} {len(body):>8} {enc:>11.1f} {dec:>11.1f}')
+
+
+def start_server(script: str, port: int, *args) -> subprocess.Popen:
+    '''
+    start server.py or aserver.py on localhost without the history
+    database, and wait until it accepts connections
+    '''
+    proc = subprocess.Popen([sys.executable, script, '-H', '127.0.0.1',
+                             '-P', str(port), '--history-db', '', *args],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f'{script} did not start on port {port}')
+
+
+async def post_loop(host: str, port: int, hostname: str, interval: float,
+                    deadline: float, latencies: list, errors: list) -> None:
+    '''
+    one simulated client.py, posting its state every interval seconds
+    on a new connection, as client.py does after an idle interval
+    '''
+    payload = synthetic_payload(hostname)
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.time() < deadline:
+        begin = time.perf_counter()
+        payload['query_time'] = time.time()
+        body = json.dumps(payload).encode()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(f'POST /submit HTTP/1.1\r\nHost: {host}:{port}\r\n'
+                         f'Content-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            if response.split(b' ', 2)[1] != b'200':
+                raise RuntimeError(response.split(b'\r\n', 1)[0].decode())
+            latencies.append(time.perf_counter() - begin)
+        except Exception as e:
+            errors.append(repr(e))
+        await asyncio.sleep(max(0, interval - (time.perf_counter() - begin)))
+
+
+async def watch_rss(pid: int, deadline: float, peak: list) -> None:
+    import psutil
+    proc = psutil.Process(pid)
+    while time.time() < deadline:
+        peak[0] = max(peak[0], proc.memory_info().rss)
+        await asyncio.sleep(0.5)
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float('nan')
+
+
+def main_load(argv):
+    '''
+    Simulate N clients posting to /submit, and report the submit latency
+    and the peak RSS of the server
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-N', '--clients', type=int, default=1000)
+    ag.add_argument('--interval', type=float, default=5.0)
+    ag.add_argument('--duration', type=float, default=30.0)
+    ag.add_argument('--server', type=str, default='aserver.py',
+                    choices=('aserver.py', 'server.py', 'none'),
+                    help='the server to start, or none to use a running one')
+    ag.add_argument('-H', '--host', type=str, default='127.0.0.1')
+    ag.add_argument('-P', '--port', type=int, default=4333)
+    ag = ag.parse_args(argv)
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    proc = None if ag.server == 'none' else start_server(ag.server, ag.port)
+    latencies, errors, peak = [], [], [0]
+    deadline = time.time() + ag.duration
+    async def run():
+        tasks = [post_loop(ag.host, ag.port, f'node{i:05d}', ag.interval,
+                           deadline, latencies, errors)
+                 for i in range(ag.clients)]
+        if proc is not None:
+            tasks.append(watch_rss(proc.pid, deadline, peak))
+        await asyncio.gather(*tasks)
+    try:
+        asyncio.run(run())
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    print(f':: {ag.server}, {ag.clients} clients posting every {ag.interval}s'
+          f' for {ag.duration}s')
+    print(f'{"requests":>10} {"errors":>7} {"req/s":>8} {"p50(ms)":>8}'
+          f' {"p99(ms)":>8} {"max(ms)":>8} {"rss(MiB)":>9}')
+    print(f'{len(latencies):>10} {len(errors):>7} {len(latencies) / ag.duration:>8.1f}'
+          f' {1e3 * percentile(latencies, 0.5):>8.2f}'
+          f' {1e3 * percentile(latencies, 0.99):>8.2f}'
+          f' {1e3 * max(latencies, default=float("nan")):>8.2f}'
+          f' {peak[0] / 2**20 if peak[0] else float("nan"):>9.1f}')
+    for (error, count) in sorted(collections.Counter(errors).items())[:5]:
+        print(f'  {count} x {error}')
+
+
+def main_consistency(argv):
+    '''
+    Start several server.py workers sharing a state backend, submit to
+    random workers, and check that every worker serves the same state
+    and renders the same dashboard, up to the live sync ages
+    '''
+    import re
+    import requests
+    import tempfile
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-W', '--workers', type=int, default=4)
+    ag.add_argument('-N', '--hosts', type=int, default=50)
+    ag.add_argument('--rounds', type=int, default=5)
+    ag.add_argument('--state', type=str, default='',
+                    help='mmap:PATH or sqlite:PATH, both are checked by default')
+    ag.add_argument('-P', '--port', type=int, default=4340)
+    ag = ag.parse_args(argv)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    states = [ag.state] if ag.state else [f'mmap:{tmpdir.name}/state.mmap',
+                                          f'sqlite:{tmpdir.name}/state.db']
+    failed = False
+    for state in states:
+        ports = [ag.port + i for i in range(ag.workers)]
+        procs = [start_server('server.py', port, '--state', state) for port in ports]
+        try:
+            rng = random.Random(0)
+            session = requests.Session()
+            begin = time.perf_counter()
+            for seed in range(ag.rounds):
+                for i in range(ag.hosts):
+                    # the last worker only catches up at the end
+                    port = rng.choice(ports[:-1] or ports)
+                    payload = synthetic_payload(f'node{i:04d}', seed=seed)
+                    session.post(f'http://127.0.0.1:{port}/submit', json=payload).raise_for_status()
+            elapsed = time.perf_counter() - begin
+            views = [session.get(f'http://127.0.0.1:{port}/api/state').json()
+                     for port in ports]
+            pages = [re.sub(r'(data-lastsync="[^"]*">)[^<]*', r'\1',
+                            session.get(f'http://127.0.0.1:{port}/').text)
+                     for port in ports]
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+        same = all(view == views[0] for view in views) \
+            and all(page == pages[0] for page in pages)
+        complete = len(views[0]['hosts']) == ag.hosts \
+            and pages[0].count('id="host-') == ag.hosts
+        failed = failed or not (same and complete)
+        print(f'{state.partition(":")[0]:>7}: {ag.workers} workers,'
+              f' {ag.rounds * ag.hosts} submits in {elapsed:.2f}s,'
+              f' generation {views[0]["generation"]}, {len(views[0]["hosts"])} hosts,'
+              f' {"consistent" if same and complete else "INCONSISTENT"}')
+    tmpdir.cleanup()
+    sys.exit(1 if failed else 0)
+
+
+def main_race(argv):
+    '''
+    Submit to server.py from several threads at once, as the threaded dev
+    server does, and check the fleet aggregates and the free GPU index
+    against a recomputation from the final records
+    '''
+    import threading
+    os.environ['GPUWATCH_HISTORY_DB'] = ''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-T', '--threads', type=int, default=8)
+    ag.add_argument('-N', '--hosts', type=int, default=20)
+    ag.add_argument('--rounds', type=int, default=50)
+    ag = ag.parse_args(argv)
+
+    errors = collections.Counter()
+    def worker(tid: int) -> None:
+        for seed in range(ag.rounds):
+            for i in range(ag.hosts):
+                try:
+                    server.ingest(synthetic_payload(f'node{i:04d}', seed=seed * ag.threads + tid))
+                except Exception as e:
+                    errors[repr(e)[:80]] += 1
+    threads = [threading.Thread(target=worker, args=(tid,)) for tid in range(ag.threads)]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+
+    expected = {key: collections.Counter() for key in server.__AGG__.keys()}
+    free_index = collections.defaultdict(list)
+    for (hostname, host) in server.__G__.items():
+        contrib = server.host_aggregates(host)
+        for key in expected.keys():
+            expected[key].update(contrib[key])
+        for entry in contrib['free_gpus']:
+            free_index[entry[3]].append(entry)
+    same = all(+server.__AGG__[key] == +expected[key] for key in expected.keys()) \
+        and {k: sorted(v) for (k, v) in free_index.items()} == server.__FREE_INDEX__
+    print(f'{ag.threads} threads, {ag.threads * ag.rounds * ag.hosts} submits'
+          f' in {elapsed:.2f}s, {sum(server.__AGG__["all"].values())} GPUs'
+          f' (expected {ag.hosts * 8}), {sum(errors.values())} errors,'
+          f' {"consistent" if same and not errors else "INCONSISTENT"}')
+    for (error, count) in errors.most_common(5):
+        print(f'  {count} x {error}')
+    sys.exit(0 if same and not errors else 1)
+
+
+def deep_sizeof(obj, seen: set = None) -> int:
+    '''
+    size of an object and of everything it references, counted once
+    '''
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for (k, v) in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    for cls in type(obj).__mro__:
+        for attr in getattr(cls, '__slots__', ()):
+            size += deep_sizeof(getattr(obj, attr, None), seen)
+    return size
+
+
+def ingest_variant(variant: str, hosts: int, rounds: int) -> None:
+    '''
+    post to /submit of server.py in this process through the flask test
+    client. The "before" variant restores the previous behaviour: raw
+    request dicts as records, echoed back, and gc.collect() every submit.
+    '''
+    import gc
+    import psutil
+    os.environ['GPUWATCH_HISTORY_DB'] = ''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    if variant == 'before':
+        server.HostRecord = lambda data: data
+        apply_submit = server.apply_submit
+        def echo_and_collect(data):
+            apply_submit(dict(data))
+            gc.collect()
+            return data, 200
+        server.apply_submit = echo_and_collect
+    client = server.app.test_client()
+    bodies = [json.dumps(synthetic_payload(f'node{i:05d}', seed=seed))
+              for seed in range(rounds) for i in range(hosts)]
+    # the first round fills the state, the others replace the records
+    for body in bodies[:hosts]:
+        client.post('/submit', data=body, content_type='application/json')
+    begin = time.perf_counter()
+    for body in bodies[hosts:]:
+        client.post('/submit', data=body, content_type='application/json')
+    elapsed = time.perf_counter() - begin
+    del bodies
+    gc.collect()
+    rss = psutil.Process().memory_info().rss / 2**20
+    records = deep_sizeof(server.__G__) / 2**20
+    print(f'{variant:>7} {hosts:>6} {(rounds - 1) * hosts / elapsed:>10.1f}'
+          f' {records:>12.2f} {rss:>9.1f}')
+
+
+def main_ingest(argv):
+    '''
+    Compare the submit throughput and the steady-state RSS of server.py
+    before and after the compact records, each in a fresh process
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-N', '--hosts', type=int, default=500)
+    ag.add_argument('--rounds', type=int, default=5)
+    ag.add_argument('--variant', type=str, default='',
+                    choices=('', 'before', 'after'))
+    ag = ag.parse_args(argv)
+    if ag.variant:
+        ingest_variant(ag.variant, ag.hosts, ag.rounds)
+        return
+    print(f':: /submit of {ag.hosts} hosts x {ag.rounds} rounds, in-process')
+    print(f'{"variant":>7} {"hosts":>6} {"submit/s":>10} {"records(MiB)":>12} {"rss(MiB)":>9}')
+    sys.stdout.flush()
+    for variant in ('before', 'after'):
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'ingest',
+                        '-N', str(ag.hosts), '--rounds', str(ag.rounds),
+                        '--variant', variant], check=True)
+
+
+def suite_server(ag) -> dict:
+    '''
+    ingest throughput and render latency of server.py, in this process
+    '''
+    os.environ['GPUWATCH_HISTORY_DB'] = ''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+    from werkzeug.datastructures import Headers
+    client = server.app.test_client()
+    fleet = synthetic_fleet(ag.hosts, ag.gpus, ag.users)
+    raw = [json.dumps(x).encode() for x in fleet]
+    compressed = [gzip.compress(x) for x in raw]
+    results = dict()
+    for (name, bodies, headers) in (
+            ('submit json', raw, {'Content-Type': 'application/json'}),
+            ('submit gzip', compressed, {'Content-Type': 'application/json',
+                                         'Content-Encoding': 'gzip'})):
+        begin = time.perf_counter()
+        for body in bodies:
+            client.post('/submit', data=body, headers=headers)
+        results[name] = (len(bodies) / (time.perf_counter() - begin), 'req/s')
+    headers = Headers({'Content-Type': 'application/json'})
+    begin = time.perf_counter()
+    for body in raw:
+        server.apply_submit(server.decode_payload(body, headers))
+    results['ingest core'] = (len(raw) / (time.perf_counter() - begin), 'req/s')
+    # one host changes between two page loads, as in production
+    changed = iter(range(10**9))
+    def resubmit():
+        server.ingest(fleet[next(changed) % len(fleet)])
+    some = ','.join(x['hostname'] for x in fleet[:4])
+    for (name, fn) in (
+            ('GET / (unchanged)', lambda: client.get('/')),
+            ('GET / (1 host changed)', lambda: (resubmit(), client.get('/'))),
+            ('GET /<4 clients>', lambda: client.get(f'/{some}')),
+            ('GET /leaderboard', lambda: client.get('/leaderboard')),
+            ('GET /api/state', lambda: (resubmit(), client.get('/api/state'))),
+            ('GET /metrics', lambda: (resubmit(), client.get('/metrics'))),
+            ('gen_client_list', server.gen_client_list),
+            ('gen_client_statistics', server.gen_client_statistics),
+            ('gen_client_find', server.gen_client_find)):
+        results[name] = (timed(fn) / 1e3, 'ms')
+    return results
+
+
+def suite_gpuwatch(ag) -> dict:
+    '''
+    gpuwatch.py stat and stat --plot on a synthetic database of a season
+    '''
+    import contextlib
+    import tempfile
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import gpuwatch
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = os.path.join(tmpdir, 'gpuwatch.db')
+        begin = time.perf_counter()
+        synthetic_database(db, gpuwatch.__SPANS__[ag.spans[-1]], ag.gpus, ag.users)
+        print(f'(synthetic database of a {ag.spans[-1]} in'
+              f' {time.perf_counter() - begin:.1f}s)', file=sys.stderr)
+        plot = os.path.join(tmpdir, 'gpuwatch.png')
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # import matplotlib once before timing
+            gpuwatch.main_stat(['-B', db, '-s', 'hour', '--plot', '--plot_output', plot])
+            for span in ag.spans:
+                for (name, argv) in (
+                        (f'gpuwatch stat -s {span}', []),
+                        (f'gpuwatch stat -s {span} --plot', ['--plot', '--plot_output', plot])):
+                    elapsed = []
+                    for _ in range(ag.repeat):
+                        begin = time.perf_counter()
+                        gpuwatch.main_stat(['-B', db, '-s', span, *argv])
+                        elapsed.append(time.perf_counter() - begin)
+                    results[name] = (1e3 * min(elapsed), 'ms')
+    return results
+
+
+def main_suite(argv):
+    '''
+    Benchmark server.py and gpuwatch.py on a synthetic fleet, optionally
+    comparing with the JSON report of a previous run
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-N', '--hosts', type=int, default=200)
+    ag.add_argument('-G', '--gpus', type=int, default=8)
+    ag.add_argument('-U', '--users', type=int, default=16)
+    ag.add_argument('--spans', type=str, default='day,week,month,season')
+    ag.add_argument('--repeat', type=int, default=3)
+    ag.add_argument('--no-server', action='store_true')
+    ag.add_argument('--no-gpuwatch', action='store_true')
+    ag.add_argument('--json', type=str, default='', help='save the report')
+    ag.add_argument('--compare', type=str, default='', help='a previous report')
+    ag.add_argument('--threshold', type=float, default=0.1,
+                    help='relative slowdown reported as a regression')
+    ag = ag.parse_args(argv)
+    ag.spans = ag.spans.split(',')
+
+    results = dict()
+    if not ag.no_server:
+        results.update(suite_server(ag))
+    if not ag.no_gpuwatch:
+        results.update(suite_gpuwatch(ag))
+    baseline = dict()
+    if ag.compare:
+        with open(ag.compare) as f:
+            baseline = json.load(f)['results']
+
+    print(f':: benchmark suite, {ag.hosts} hosts x {ag.gpus} GPUs x {ag.users} users')
+    print(f'{"benchmark":<36} {"value":>10} {"unit":<6} {"baseline":>10} {"change":>8}')
+    regressions = 0
+    for (name, (value, unit)) in results.items():
+        line = f'{name:<36} {value:>10.2f} {unit:<6}'
+        if name in baseline:
+            base = baseline[name][0]
+            # req/s is better when higher, ms when lower
+            slowdown = (base - value) / base if unit == 'req/s' else (value - base) / base
+            regressed = slowdown > ag.threshold
+            regressions += regressed
+            line += f' {base:>10.2f} {-100 * slowdown:>+7.1f}%{" REGRESSION" if regressed else ""}'
+        print(line.rstrip())
+    if ag.json:
+        with open(ag.json, 'w') as f:
+            json.dump({'config': {k: getattr(ag, k) for k in ('hosts', 'gpus', 'users', 'spans')},
+                       'results': results}, f, indent=2)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    eval(f'main_{sys.argv[1]}')(sys.argv[2:])
@@ -18,20 +18,23 @@ import subprocess
 import argparse
 import socket
 import rich
-from collections import defaultdict
-import gpustat
-import requests
+from collections import defaultdict, Counter
 import time
 import gzip
 import psutil
 import json
 console = rich.get_console()
 
+# gpustat, pynvml and requests are imported where they are needed,
+# since their import time is not negligible on a busy node.
 
-def gpustat_filtered() -> object:
+
+def gpustat_filtered(nprocs: bool = False) -> object:
     '''
-    return json-serializable gpustat results
+    return json-serializable gpustat results. With nprocs, the number of
+    processes of each user is also kept for every GPU.
     '''
+    import gpustat
     # make a new query
     stat = gpustat.new_query().jsonify()
     # reformat time
@@ -47,7 +50,9 @@ def gpustat_filtered() -> object:
         # convert per-process stat into per-user stat
         users = defaultdict(int)
         for p in gpu['processes']:
-            users[p['username']] += p['gpu_memory_usage']
+            users[p['username']] += p['gpu_memory_usage'] or 0
+        if nprocs:
+            gpu['nprocs'] = dict(Counter(p['username'] for p in gpu['processes']))
         gpu.pop('processes')
         gpu['users'] = dict(users)
     # should be safe to use
@@ -63,44 +68,618 @@ def psutil_stat() -> object:
             }
 
 
+class NvmlSampler(object):
+    '''
+    Long-lived sampler producing the same document as gpustat_filtered().
+    Unlike gpustat.new_query(), NVML is initialised once and the device
+    handles are reused across samples. After an NVML error, the handles
+    are dropped and re-opened at the next sample.
+    '''
+
+    def __init__(self, hostname: str, nvml=None, nprocs: bool = False):
+        if nvml is None:
+            import pynvml as nvml
+        self.nvml = nvml
+        self.hostname = hostname
+        self.nprocs = nprocs
+        self.handles = None
+        # pid -> username of the processes of the previous sample, and of
+        # this one. The processes outlive many samples, but a pid missing
+        # from a sample may be reused by another user.
+        self.usernames = dict()
+        self.seen = dict()
+
+    def open(self) -> None:
+        N = self.nvml
+        N.nvmlInit()
+        self.driver_version = self.__decode(N.nvmlSystemGetDriverVersion())
+        self.handles = [N.nvmlDeviceGetHandleByIndex(i)
+                        for i in range(N.nvmlDeviceGetCount())]
+        self.names = [self.__decode(N.nvmlDeviceGetName(h))
+                      for h in self.handles]
+        self.totals = [N.nvmlDeviceGetMemoryInfo(h).total // 1024**2
+                       for h in self.handles]
+
+    def close(self) -> None:
+        if self.handles is not None:
+            self.handles = None
+            try:
+                self.nvml.nvmlShutdown()
+            except self.nvml.NVMLError:
+                pass
+
+    @staticmethod
+    def __decode(b) -> str:
+        return b.decode() if isinstance(b, bytes) else b
+
+    def __username(self, pid: int) -> str:
+        if pid not in self.seen:
+            if pid in self.usernames:
+                self.seen[pid] = self.usernames[pid]
+            else:
+                try:
+                    self.seen[pid] = psutil.Process(pid).username()
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    return '?'
+        return self.seen[pid]
+
+    def __supported(self, query, handle, default):
+        '''
+        query a field that some GPUs do not support, like gpustat does
+        '''
+        try:
+            return query(handle)
+        except self.nvml.NVMLError_NotSupported:
+            return default
+
+    def __gpu(self, index: int) -> dict:
+        N = self.nvml
+        handle = self.handles[index]
+        memory = N.nvmlDeviceGetMemoryInfo(handle)
+        utilization = self.__supported(N.nvmlDeviceGetUtilizationRates, handle, None)
+        processes = dict()
+        for p in (self.__supported(N.nvmlDeviceGetComputeRunningProcesses, handle, []) +
+                  self.__supported(N.nvmlDeviceGetGraphicsRunningProcesses, handle, [])):
+            processes[p.pid] = (p.usedGpuMemory or 0) // 1024**2
+        users = defaultdict(int)
+        for (pid, usage) in processes.items():
+            users[self.__username(pid)] += usage
+        gpu = {
+                'index': index,
+                'name': self.names[index],
+                # the server compares it, unknown counts as idle
+                'utilization.gpu': utilization.gpu if utilization is not None else 0,
+                'memory.used': memory.used // 1024**2,
+                'memory.total': self.totals[index],
+                'users': dict(users),
+                }
+        if self.nprocs:
+            gpu['nprocs'] = dict(Counter(self.__username(pid) for pid in processes))
+        return gpu
+
+    def sample(self) -> dict:
+        if self.handles is None:
+            self.open()
+        self.seen = dict()
+        try:
+            gpus = [self.__gpu(i) for i in range(len(self.handles))]
+        except self.nvml.NVMLError:
+            self.close()
+            raise
+        # forget the processes that are gone
+        self.usernames = self.seen
+        return {
+                'hostname': self.hostname,
+                'driver_version': self.driver_version,
+                'query_time': time.time(),
+                'gpus': gpus,
+                }
+
+
+class FakeNvml(object):
+    '''
+    Minimal stand-in for the pynvml module, for running the client on a
+    machine without GPU. Processes are attributed to the current process,
+    and NVML errors are raised at the given rate.
+    '''
+
+    class NVMLError(Exception):
+        pass
+
+    class NVMLError_NotSupported(NVMLError):
+        pass
+
+    def __init__(self, count: int = 4, fail_rate: float = 0.0, seed: int = 0):
+        import random
+        from types import SimpleNamespace
+        self.random = random.Random(seed)
+        self.record = SimpleNamespace
+        self.count = count
+        self.fail_rate = fail_rate
+        self.initialised = False
+
+    def __check(self) -> None:
+        if not self.initialised:
+            raise self.NVMLError('NVML not initialised')
+        if self.random.random() < self.fail_rate:
+            self.initialised = False
+            raise self.NVMLError('injected driver error')
+
+    def nvmlInit(self) -> None:
+        self.initialised = True
+
+    def nvmlShutdown(self) -> None:
+        self.initialised = False
+
+    def nvmlSystemGetDriverVersion(self) -> str:
+        return '000.00.fake'
+
+    def nvmlDeviceGetCount(self) -> int:
+        self.__check()
+        return self.count
+
+    def nvmlDeviceGetHandleByIndex(self, index: int) -> int:
+        return index
+
+    def nvmlDeviceGetName(self, handle: int) -> str:
+        return 'Fake GPU'
+
+    def nvmlDeviceGetMemoryInfo(self, handle: int) -> object:
+        self.__check()
+        total = 24 * 1024**3
+        return self.record(total=total, used=int(total * self.random.random()))
+
+    def nvmlDeviceGetUtilizationRates(self, handle: int) -> object:
+        self.__check()
+        return self.record(gpu=self.random.randint(0, 100), memory=0)
+
+    def nvmlDeviceGetComputeRunningProcesses(self, handle: int) -> list:
+        self.__check()
+        if self.random.random() < 0.5:
+            return []
+        return [self.record(pid=os.getpid(), usedGpuMemory=self.random.randint(1, 8) * 1024**3)]
+
+    def nvmlDeviceGetGraphicsRunningProcesses(self, handle: int) -> list:
+        return []
+
+
+class GpustatSampler(object):
+    '''
+    sampler making a fresh gpustat query for each sample
+    '''
+
+    def sample(self) -> dict:
+        return gpustat_filtered()
+
+    def close(self) -> None:
+        pass
+
+
+def make_sampler(args) -> object:
+    if args.sampler == 'gpustat':
+        return GpustatSampler()
+    elif args.sampler == 'fake':
+        return NvmlSampler(args.hostname, nvml=FakeNvml(fail_rate=args.fake_fail_rate))
+    else:
+        return NvmlSampler(args.hostname)
+
+
+class Spool(object):
+    '''
+    Bounded on-disk queue of the samples not yet accepted by the server.
+    When full, the oldest samples are dropped first.
+    '''
+
+    def __init__(self, path: str, maxlen: int):
+        import sqlite3
+        self.maxlen = maxlen
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''PRAGMA journal_mode=WAL''')
+        self.conn.execute(
+            '''CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT)''')
+
+    def __len__(self) -> int:
+        return self.conn.execute('''SELECT COUNT(*) FROM spool''').fetchone()[0]
+
+    def append(self, payload: str) -> None:
+        with self.conn:
+            cur = self.conn.execute('''INSERT INTO spool (payload) VALUES (?)''', (payload,))
+            self.conn.execute('''DELETE FROM spool WHERE id <= ?''',
+                              (cur.lastrowid - self.maxlen,))
+
+    def peek(self, n: int) -> list:
+        return self.conn.execute(
+            '''SELECT id, payload FROM spool ORDER BY id LIMIT ?''', (n,)).fetchall()
+
+    def newest(self) -> tuple:
+        return self.conn.execute(
+            '''SELECT id, payload FROM spool ORDER BY id DESC LIMIT 1''').fetchone()
+
+    def drop(self, last_id: int) -> None:
+        with self.conn:
+            self.conn.execute('''DELETE FROM spool WHERE id <= ?''', (last_id,))
+
+    def remove(self, row_id: int) -> None:
+        with self.conn:
+            self.conn.execute('''DELETE FROM spool WHERE id = ?''', (row_id,))
+
+
+def post_batch(session, rows: list, args, headers: dict) -> object:
+    body = ('[' + ','.join(payload for (_, payload) in rows) + ']').encode()
+    if args.compress:
+        body = gzip.compress(body)
+    r = session.post(args.batch_url, data=body, headers=headers, timeout=30)
+    console.print('HTTP Status:', r.status_code, f'({len(rows)} samples)')
+    return r
+
+
+def flush_spool(session, spool: Spool, args, headers: dict) -> None:
+    '''
+    send the spooled samples in batches until the spool is empty. A batch
+    refused with 400 or 422 is split until the sample at fault is found
+    and dropped, so that it cannot hold back the newer ones. A server
+    without /submit_batch only gets the newest sample through /submit, the
+    older ones are dropped.
+    '''
+    batch = args.batch
+    while True:
+        rows = spool.peek(batch)
+        if not rows:
+            break
+        if not args.batch_url:
+            row_id, payload = spool.newest()
+            r = post_payload(session, args.server_url, json.loads(payload), args)
+            console.print('HTTP Status:', r.status_code, '(newest spooled sample)')
+            if r.status_code in (200, 400, 422):
+                spool.drop(row_id)
+            break
+        r = post_batch(session, rows, args, headers)
+        if r.status_code == 200:
+            spool.drop(rows[-1][0])
+            batch = args.batch
+        elif r.status_code in (404, 405):
+            console.print(f'{args.batch_url} is not served, falling back to /submit')
+            args.batch_url = ''
+        elif r.status_code == 413 and len(rows) > 1:
+            # too large for the server or a proxy, from now on
+            args.batch = batch = len(rows) // 2
+        elif r.status_code in (400, 422):
+            # a sample at fault
+            if len(rows) > 1:
+                batch = len(rows) // 2
+            else:
+                console.print(f'dropped a sample refused with {r.status_code}')
+                spool.remove(rows[0][0])
+        elif r.status_code < 500:
+            # e.g. 401, 403, 408 or 429, nothing wrong with the samples
+            break
+        else:
+            # the server fails, or only on a sample of this batch: check
+            # with the newest sample, which is then already delivered
+            newest = spool.newest()
+            if post_batch(session, [newest], args, headers).status_code != 200:
+                break
+            spool.remove(newest[0])
+            if len(rows) > 1:
+                batch = len(rows) // 2
+            elif rows[0][0] != newest[0]:
+                console.print(f'dropped a sample failing with {r.status_code}')
+                spool.remove(rows[0][0])
+
+
+def delta_encode(baseline: dict, doc: dict) -> dict:
+    '''
+    return the fields of doc that differ from baseline, or None if the
+    GPU layout changed and the full state has to be sent
+    '''
+    if len(baseline['gpus']) != len(doc['gpus']):
+        return None
+    delta = {k: v for (k, v) in doc.items()
+             if k != 'gpus' and baseline.get(k) != v}
+    gpus = dict()
+    for (old, new) in zip(baseline['gpus'], doc['gpus']):
+        if old['index'] != new['index']:
+            return None
+        changed = {k: v for (k, v) in new.items() if old.get(k) != v}
+        if changed:
+            gpus[str(new['index'])] = changed
+    if gpus:
+        delta['gpus'] = gpus
+    return delta
+
+
+class DeltaEncoder(object):
+    '''
+    Client side of the delta protocol of /submit. The first submission
+    carries the full state, the following ones only the fields changed
+    since the last state acknowledged by the server, tagged with
+    consecutive sequence numbers. The server answers 409 when it detects
+    a sequence gap, and the full state is sent again.
+    '''
+
+    def __init__(self, full_every: int):
+        self.baseline = None
+        self.seq = 0
+        # number of deltas after which the full state is sent anyway
+        self.full_every = full_every
+        self.count = 0
+
+    def encode(self, doc: dict) -> dict:
+        delta = None
+        if self.baseline is not None and self.count < self.full_every:
+            delta = delta_encode(self.baseline, doc)
+        if delta is None:
+            return doc | {'seq': self.seq + 1}
+        return {'hostname': doc['hostname'], 'seq': self.seq + 1, 'delta': delta}
+
+    def ack(self, payload: dict, doc: dict) -> None:
+        self.seq = payload['seq']
+        self.baseline = doc
+        self.count = self.count + 1 if 'delta' in payload else 0
+
+    def reset(self) -> None:
+        self.baseline = None
+
+
+# version of the payload layout, sent along with the binary formats
+SCHEMA_VERSION = 1
+
+
+def encode_payload(payload, fmt: str, compress: bool) -> tuple:
+    '''
+    serialize a payload for /submit, returning the body and its headers
+    '''
+    if fmt == 'msgpack':
+        import msgpack
+        body = msgpack.packb(payload)
+        headers = {'Content-Type': 'application/msgpack',
+                   'X-GPUWatch-Schema': str(SCHEMA_VERSION)}
+    else:
+        body = json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json'}
+    if compress:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
+
+
+def post_payload(session, url: str, payload, args) -> object:
+    body, headers = encode_payload(payload, args.format, args.compress)
+    r = session.post(url, data=body, headers=headers, timeout=30)
+    if r.status_code == 415 and args.format != 'json':
+        # the server cannot decode this format, fall back to JSON
+        console.print(f'server does not accept {args.format}, falling back to json')
+        args.format = 'json'
+        return post_payload(session, url, payload, args)
+    return r
+
+
+class WindowAggregator(object):
+    '''
+    Aggregate the samples taken between two reports. The report is the
+    latest sample, with the min/mean/max utilization and the max memory
+    usage of each GPU over the window added next to the instant values.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.begin = time.time()
+        self.samples = 0
+        # GPU index -> (utilization values, max memory used)
+        self.gpus = dict()
+
+    def add(self, sample: dict) -> None:
+        self.samples += 1
+        for gpu in sample['gpus']:
+            utils, mem_max = self.gpus.get(gpu['index'], ([], 0))
+            utils.append(gpu['utilization.gpu'])
+            self.gpus[gpu['index']] = (utils, max(mem_max, gpu['memory.used']))
+
+    def restart(self, gpu: dict) -> None:
+        '''
+        start the window of a GPU again from this sample
+        '''
+        self.gpus[gpu['index']] = ([gpu['utilization.gpu']], gpu['memory.used'])
+
+    def summary(self, sample: dict) -> dict:
+        gpus = []
+        for gpu in sample['gpus']:
+            utils, mem_max = self.gpus.get(gpu['index'], ([gpu['utilization.gpu']],
+                                                          gpu['memory.used']))
+            gpus.append(gpu | {
+                'utilization.gpu.min': min(utils),
+                'utilization.gpu.mean': round(sum(utils) / len(utils), 1),
+                'utilization.gpu.max': max(utils),
+                'memory.used.max': mem_max,
+                })
+        return sample | {'gpus': gpus, 'window': round(time.time() - self.begin, 1),
+                         'window_samples': self.samples}
+
+
+def __is_free(gpu: dict) -> bool:
+    '''
+    same rule as server.py: no users, or (almost) no utilization and memory
+    '''
+    users = set(gpu['users'].keys()) - {'gdm', 'gdm3'}
+    return len(users) == 0 \
+        or gpu['utilization.gpu'] <= 2 \
+        and gpu['memory.used'] / gpu['memory.total'] < 0.02
+
+
+def significant_change(last: dict, sample: dict, util_jump: float) -> str:
+    '''
+    the reason to report this sample right away, compared with the last
+    reported one, or an empty string. Utilization jumps are only checked
+    when util_jump is positive.
+    '''
+    last_gpus = {gpu['index']: gpu for gpu in last['gpus']}
+    if set(last_gpus.keys()) != {gpu['index'] for gpu in sample['gpus']}:
+        return 'gpus'
+    for gpu in sample['gpus']:
+        prev = last_gpus[gpu['index']]
+        if set(gpu['users'].keys()) != set(prev['users'].keys()):
+            return 'users'
+        if __is_free(gpu) != __is_free(prev):
+            return 'free' if __is_free(gpu) else 'busy'
+    for gpu in sample['gpus']:
+        prev = last_gpus[gpu['index']]
+        if util_jump > 0 and abs(gpu['utilization.gpu'] - prev['utilization.gpu']) >= util_jump:
+            return 'util'
+    return ''
+
+
+def report(session, doc: dict, spool, encoder, args, headers: dict, note: str) -> None:
+    '''
+    send one document to the server, through the spool or the delta encoder
+    when enabled
+    '''
+    if spool is not None:
+        spool.append(json.dumps(doc))
+        flush_spool(session, spool, args, headers)
+    elif encoder is not None:
+        payload = encoder.encode(doc)
+        r = post_payload(session, args.server_url, payload, args)
+        if r.status_code == 409:
+            # the server lost track of our state, send all of it
+            encoder.reset()
+            payload = encoder.encode(doc)
+            r = post_payload(session, args.server_url, payload, args)
+        if r.status_code == 200:
+            encoder.ack(payload, doc)
+        console.print('HTTP Status:', r.status_code, f'({note},',
+                      'delta)' if 'delta' in payload else 'full)')
+    else:
+        r = post_payload(session, args.server_url, doc, args)
+        console.print('HTTP Status:', r.status_code, f'({note})')
+
+
 def client_loop(args):
     '''
     infinite loop for client side
     '''
+    import requests
+    # keep-alive connection pool reused by all the posts
+    session = requests.Session()
     headers = {'Content-Type': 'application/json',}
     if args.compress:
         headers['Content-Encoding'] = 'gzip'
+    sampler = make_sampler(args)
+    spool = Spool(args.spool, args.spool_max) if args.spool else None
+    encoder = DeltaEncoder(args.full_every) if args.delta else None
+    # adaptive mode: sample every --sample-interval, report on changes
+    period = args.sample_interval if args.adaptive else args.interval
+    window = WindowAggregator()
+    last, last_time = None, 0.0
+    # back off after sampler errors, up to a minute
+    backoff = period
     while True:
         try:
-            s = gpustat_filtered()
-            p = psutil_stat()
-            if args.compress:
-                j = gzip.compress(json.dumps(s|p).encode())
-                r = requests.post(ag.server_url, data=j, headers=headers)
+            t0 = time.perf_counter()
+            s = sampler.sample()
+            latency = 1000 * (time.perf_counter() - t0)
+            backoff = period
+        except Exception as e:
+            console.print(time.time(), 'sampler error:', repr(e))
+            sampler.close()
+            if args.oneshot:
+                raise
+            time.sleep(backoff)
+            backoff = min(2 * backoff, 60)
+            continue
+        note = f'sampled in {latency:.1f}ms'
+        if args.adaptive:
+            window.add(s)
+            now = time.monotonic()
+            if last is None:
+                reason = 'first'
             else:
-                r = requests.post(ag.server_url, json=s|p)
-            console.print('HTTP Status:', r.status_code)
-        except requests.ConnectionError:
-            console.print(time.time(), 'connection error')
-        except e:
-            print(e)
+                # utilization alone may swing every second, at most one
+                # report per --interval for it
+                reason = significant_change(
+                    last, s, args.util_jump if now - last_time >= args.interval else 0)
+                if not reason and now - last_time >= args.heartbeat:
+                    reason = 'heartbeat'
+            if not reason:
+                time.sleep(max(0.0, period - (time.perf_counter() - t0)))
+                continue
+            if last is not None:
+                # the window of a GPU that has just become free still holds
+                # its busy samples, which would keep it busy on the server
+                prev = {gpu['index']: gpu for gpu in last['gpus']}
+                for gpu in s['gpus']:
+                    if gpu['index'] in prev and __is_free(gpu) != __is_free(prev[gpu['index']]):
+                        window.restart(gpu)
+            doc = window.summary(s)
+            note = f'{reason}, {window.samples} samples'
+            last, last_time = s, now
+            window.reset()
+        else:
+            doc = s
+        p = psutil_stat()
+        p['sample_latency_ms'] = latency
+        try:
+            report(session, doc|p, spool, encoder, args, headers, note)
+        except requests.RequestException:
+            console.print(time.time(), 'connection error',
+                          '' if spool is None else f'({len(spool)} samples spooled)')
         if args.oneshot:
             break
-        time.sleep(args.interval)
-
+        time.sleep(max(0.0, period - (time.perf_counter() - t0)) if args.adaptive else period)
 
 if __name__ == '__main__':
-    ag = argparse.ArgumentParser()
-    ag.add_argument('-S', '--server-url', type=str, default='http://localhost:4222/submit')
-    ag.add_argument('--hostname', type=str, default=socket.gethostname())
-    ag.add_argument('--interval', type=int, default=5)
-    ag.add_argument('--oneshot', '-1', action='store_true')
-    ag.add_argument('--compress', '-c', action='store_true')
-    ag = ag.parse_args()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-S', '--server-url', type=str, default='http://localhost:4222/submit')
+    parser.add_argument('--hostname', type=str, default=socket.gethostname())
+    parser.add_argument('--interval', type=int, default=5)
+    parser.add_argument('--oneshot', '-1', action='store_true')
+    parser.add_argument('--compress', '-c', action='store_true')
+    parser.add_argument('--format', '-f', type=str, default='json',
+                        choices=('json', 'msgpack'),
+                        help='wire format of /submit, see bench.py wire')
+    parser.add_argument('--sampler', type=str, default='nvml',
+                        choices=('nvml', 'gpustat', 'fake'),
+                        help='nvml keeps NVML open across samples, gpustat '
+                        'queries from scratch, fake needs no GPU')
+    parser.add_argument('--fake-fail-rate', type=float, default=0.0,
+                        help='rate of injected NVML errors for --sampler=fake')
+    parser.add_argument('--spool', type=str, default='',
+                        help='buffer samples in this SQLite file and send them '
+                        'in batches, so that nothing is lost while the server is down')
+    parser.add_argument('--spool-max', type=int, default=17280,
+                        help='maximum number of spooled samples (default: a day)')
+    parser.add_argument('--batch', type=int, default=120,
+                        help='maximum number of samples per batch')
+    parser.add_argument('--batch-url', type=str, default='',
+                        help='default: --server-url with /submit replaced by /submit_batch')
+    parser.add_argument('--delta', action='store_true',
+                        help='only send the fields changed since the last submission')
+    parser.add_argument('--full-every', type=int, default=720,
+                        help='send the full state after this many deltas')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='sample every --sample-interval, and only report on '
+                        'significant changes, at most every --heartbeat otherwise')
+    parser.add_argument('--sample-interval', type=float, default=1.0)
+    parser.add_argument('--heartbeat', type=float, default=30.0,
+                        help='seconds between the reports without a change, below the '
+                        '60s after which the server shows the host as disconnected')
+    parser.add_argument('--util-jump', type=float, default=30.0,
+                        help='utilization change (in percent) reported right away')
+    ag = parser.parse_args()
+    if ag.delta and ag.spool:
+        parser.error('--delta cannot be used together with --spool')
+    if ag.adaptive and ag.heartbeat >= 60:
+        parser.error('--heartbeat must be below the 60s after which the server '
+                     'considers the host disconnected')
+    if not ag.batch_url:
+        ag.batch_url = re.sub(r'/submit$', '/submit_batch', ag.server_url)
+        if ag.spool and ag.server_url and ag.batch_url == ag.server_url:
+            parser.error('--batch-url is required when --server-url does not end in /submit')
     console.print(ag)
 
     if not ag.server_url:
-        s = gpustat_filtered()
+        s = make_sampler(ag).sample()
         console.print('[violet on white]>_< Server URL not specified. Printing only.')
         console.print(s)
     else:
@@ -10,15 +10,18 @@ Configuration:
 * * * * * lumin cd && python3 gpuwatch.py snapshot
 * * * * * lumin cd && /home/lumin/anaconda3/bin/python3 gpuwatch.py snapshot
 ```
+    (2) or keep `python3 gpuwatch.py daemon` running, e.g. as a systemd unit.
+When client.py is next to gpuwatch.py, the GPUs are queried in-process
+instead of parsing the output of the gpustat command.
 '''
 from termcolor import cprint, colored
 import argparse
 import collections
 import glob
 import json
-import json
 import os
 import re
+import socket
 import sqlite3
 import statistics
 import subprocess
@@ -28,145 +31,613 @@ import time
 __DB__ = '/var/log/__gpuwatch__.db' if os.getuid() == 0 else '__gpuwatch__.db'
 
 
-def __create_db_if_not_exist():
-    if not os.path.exists(__DB__):
-        conn = sqlite3.connect(__DB__)
-        c = conn.cursor()
-        c.execute(
-            '''CREATE TABLE userwatch (time real, name text, processes inteter, vmem_occupy real)''')
-        c.execute(
-            '''CREATE TABLE gpuwatch (time real, gpu_util real, vmem_ratio real)''')
-        conn.commit()
-        conn.close()
+# version of the database schema, stored as PRAGMA user_version
+__SCHEMA__ = 2
+# spans of the stat command, in seconds
+__SPANS__ = {'hour': 3600, 'day': 3600*24, 'week': 3600*24*7,
+             'month': 3600*24*30, 'season': 3600*24*90, 'year': 3600*24*365}
+# rollup tables and their bucket width, in seconds
+__ROLLUPS__ = {'hourly': 3600, 'daily': 3600*24}
+# spans answered from a rollup table instead of the raw snapshots
+__SPAN_ROLLUP__ = {'month': 'hourly', 'season': 'hourly', 'year': 'daily'}
+# the plots are at most this wide, in inches, at this many dots per inch
+__PLOT_WIDTH__ = 20
+__PLOT_DPI__ = 100
+# migrations from each schema version to the next one
+__MIGRATIONS__ = {
+    # v0 -> v1: integer timestamps, and indexes for the time range queries
+    0: '''
+    CREATE TABLE IF NOT EXISTS userwatch (time real, name text, processes inteter, vmem_occupy real);
+    CREATE TABLE IF NOT EXISTS gpuwatch (time real, gpu_util real, vmem_ratio real);
+    ALTER TABLE userwatch RENAME TO userwatch_v0;
+    ALTER TABLE gpuwatch RENAME TO gpuwatch_v0;
+    CREATE TABLE userwatch (time integer, name text, processes integer, vmem_occupy real);
+    CREATE TABLE gpuwatch (time integer, gpu_util real, vmem_ratio real);
+    INSERT INTO userwatch SELECT CAST(time AS integer), name, processes, vmem_occupy FROM userwatch_v0;
+    INSERT INTO gpuwatch SELECT CAST(time AS integer), gpu_util, vmem_ratio FROM gpuwatch_v0;
+    DROP TABLE userwatch_v0;
+    DROP TABLE gpuwatch_v0;
+    CREATE INDEX userwatch_time ON userwatch (time);
+    CREATE INDEX userwatch_name_time ON userwatch (name, time);
+    CREATE INDEX gpuwatch_time ON gpuwatch (time);
+    ''',
+    # v1 -> v2: hourly and daily rollups, filled from the existing snapshots
+    1: ''.join(f'''
+    CREATE TABLE gpuwatch_{table} (bucket integer PRIMARY KEY, n integer, gpu_util_sum real, vmem_ratio_sum real);
+    CREATE TABLE userwatch_{table} (bucket integer, name text, n integer, processes_sum integer, vmem_occupy_sum real,
+        PRIMARY KEY (bucket, name)) WITHOUT ROWID;
+    INSERT INTO gpuwatch_{table} SELECT time - time % {width}, COUNT(*), SUM(gpu_util), SUM(vmem_ratio)
+        FROM gpuwatch GROUP BY 1;
+    INSERT INTO userwatch_{table} SELECT time - time % {width}, name, COUNT(*), SUM(processes), SUM(vmem_occupy)
+        FROM userwatch GROUP BY 1, 2;
+    ''' for (table, width) in __ROLLUPS__.items()),
+    }
+
+
+def __connect(path: str) -> sqlite3.Connection:
+    '''
+    Open the database, creating it or upgrading its schema in place
+    '''
+    conn = sqlite3.connect(path)
+    version = conn.execute('''PRAGMA user_version''').fetchone()[0]
+    if version == 0:
+        # lets the compact command give the free pages back to the system,
+        # this only takes effect here for new databases
+        conn.execute('''PRAGMA auto_vacuum = INCREMENTAL''')
+    while version < __SCHEMA__:
+        conn.executescript('BEGIN;' + __MIGRATIONS__[version] +
+                           f'PRAGMA user_version = {version + 1}; COMMIT;')
+        version += 1
+    return conn
+
+
+# recorded gpustat outputs, with the default options and with -FP
+__GPUSTAT_RECORDED__ = ('''
+gpu-node-1               Mon Oct 16 12:00:00 2023  535.129.03
+[0] NVIDIA GeForce RTX 3090 | 65°C,  98 % | 20489 / 24576 MB | alice(19843M) bob(640M)
+[1] NVIDIA GeForce RTX 3090 | 31°C,   0 % |     4 / 24576 MB |
+[2] NVIDIA GeForce RTX 3090 | ??°C,  47 % | 11012 / 24576 MB | alice(5500M) alice(5500M)
+''', '''
+gpu-node-2               Mon Oct 16 12:00:00 2023  535.129.03
+[0] NVIDIA A100-SXM4-80GB | 40°C,  30 %,  97 %,  310 / 400 W | 70000 / 81920 MB | carol(69995M)
+[1] NVIDIA A100-SXM4-80GB | 35°C,  30 %,   0 %,   60 / 400 W |     5 / 81920 MB |
+''')
+
+
+def __parse_gpustat_text(text: str) -> dict:
+    '''
+    Parse the text output of the gpustat command into the same structure
+    as gpustat_filtered(nprocs=True) of client.py. This is only the
+    fallback when gpustat cannot be queried in-process.
+
+    >>> stat = __parse_gpustat_text(__GPUSTAT_RECORDED__[0])
+    >>> [(g['index'], g['utilization.gpu'], g['memory.used'], g['memory.total']) for g in stat['gpus']]
+    [(0, 98, 20489, 24576), (1, 0, 4, 24576), (2, 47, 11012, 24576)]
+    >>> stat['gpus'][0]['name'], stat['gpus'][0]['users'], stat['gpus'][2]['nprocs']
+    ('NVIDIA GeForce RTX 3090', {'alice': 19843, 'bob': 640}, {'alice': 2})
+    >>> stat = __parse_gpustat_text(__GPUSTAT_RECORDED__[1])
+    >>> [(g['utilization.gpu'], g['memory.used'], g['users']) for g in stat['gpus']]
+    [(97, 70000, {'carol': 69995}), (0, 5, {})]
+    '''
+    gpus = []
+    for line in text.splitlines():
+        m = re.match(r'\[(\d+)\]\s*([^|]*?)\s*\|([^|]*)\|\s*(\d+)\s*/\s*(\d+)\s*.B\s*\|?(.*)',
+                     line)
+        if m is None:
+            continue
+        index, name, stat, used, total, procs = m.groups()
+        users = collections.defaultdict(int)
+        nprocs = collections.Counter()
+        for (user, usage) in re.findall(r'([\w.-]+)\((\d+)M\)', procs):
+            users[user] += int(usage)
+            nprocs[user] += 1
+        gpus.append({
+            'index': int(index),
+            'name': name,
+            # the last percentage, after the optional fan speed
+            'utilization.gpu': int(re.findall(r'(\d+)\s%', stat)[-1]),
+            'memory.used': int(used),
+            'memory.total': int(total),
+            'users': dict(users),
+            'nprocs': dict(nprocs),
+            })
+    return {'gpus': gpus}
+
+
+def __collect_text() -> dict:
+    gpustat = subprocess.Popen(['gpustat', '--no-color'], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE).communicate()[0].decode().strip()
+    return __parse_gpustat_text(gpustat)
+
+
+def __collect(sampler=None) -> dict:
+    '''
+    Query the GPUs in-process through client.py, falling back to parsing
+    the output of the gpustat command.
+    '''
+    try:
+        if sampler is not None:
+            return sampler.sample()
+        from client import gpustat_filtered
+        return gpustat_filtered(nprocs=True)
+    except Exception:
+        return __collect_text()
+
+
+def __snapshot_rows(stamp: int, stat: dict) -> tuple:
+    '''
+    compute the gpuwatch row and the userwatch rows of a snapshot
+    '''
+    gpus = stat['gpus']
+    vram_total = sum(gpu['memory.total'] for gpu in gpus)
+    vram_ratio = sum(gpu['memory.used'] for gpu in gpus) / vram_total
+    gpu_util = statistics.mean(gpu['utilization.gpu'] for gpu in gpus)
+    processes, vram_occupy = collections.Counter(), collections.Counter()
+    for gpu in gpus:
+        processes.update(gpu['nprocs'])
+        vram_occupy.update(gpu['users'])
+    userrows = [(stamp, user, n, vram_occupy[user] / vram_total)
+                for (user, n) in processes.items()]
+    return (stamp, gpu_util, vram_ratio), userrows
+
+
+def __insert_snapshot(conn: sqlite3.Connection, stamp: int, stat: dict) -> None:
+    if not stat['gpus']:
+        return
+    gpurow, userrows = __snapshot_rows(stamp, stat)
+    with conn:
+        conn.executemany('''INSERT INTO userwatch VALUES (?, ?, ?, ?)''', userrows)
+        conn.execute('''INSERT INTO gpuwatch VALUES (?, ?, ?)''', gpurow)
+        # maintain the rollups incrementally
+        for (table, width) in __ROLLUPS__.items():
+            bucket = stamp - stamp % width
+            conn.execute(f'''INSERT INTO gpuwatch_{table} VALUES (?, 1, ?, ?)
+                         ON CONFLICT (bucket) DO UPDATE SET n = n + 1,
+                         gpu_util_sum = gpu_util_sum + excluded.gpu_util_sum,
+                         vmem_ratio_sum = vmem_ratio_sum + excluded.vmem_ratio_sum''',
+                         (bucket, *gpurow[1:]))
+            conn.executemany(f'''INSERT INTO userwatch_{table} VALUES (?, ?, 1, ?, ?)
+                             ON CONFLICT (bucket, name) DO UPDATE SET n = n + 1,
+                             processes_sum = processes_sum + excluded.processes_sum,
+                             vmem_occupy_sum = vmem_occupy_sum + excluded.vmem_occupy_sum''',
+                             [(bucket, *row[1:]) for row in userrows])
 
 
 def main_snapshot(argv):
     '''
     Record the current gpustat data into the database
     '''
-    __create_db_if_not_exist()
     ag = argparse.ArgumentParser()
     ag.add_argument('-B', '--db', type=str, default=__DB__)
     ag = ag.parse_args(argv)
 
-    stamp = time.time()
-    gpustat = subprocess.Popen(['gpustat'], stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE).communicate()[0].decode().strip()
+    stamp = int(time.time())
+    stat = __collect()
+    conn = __connect(ag.db)
+    __insert_snapshot(conn, stamp, stat)
+    conn.close()
+
 
-    names = re.findall(r'(\w+)\(\d+M\)', gpustat)
-    counter = collections.Counter(names)
-    vram_used, vram_total = tuple(
-        zip(*re.findall(r'(\d+)\s/\s(\d+)\s.B', gpustat)))
-    vram_ratio = sum(int(x) for x in vram_used) / sum(int(x)
-                                                      for x in vram_total)
-    gpu_util = statistics.mean(int(x)
-                               for x in re.findall(r'(\d+)\s%', gpustat))
-    vram_occupy = {user: sum(int(x) for x in re.findall(rf'{user}\((\d+)\w\)',
-                                                        gpustat)) / sum(int(x) for x in vram_total) for user in counter.keys()}
-
-    conn = sqlite3.connect(ag.db)
+def main_daemon(argv):
+    '''
+    Record one snapshot per interval, without starting a new process and
+    re-initialising NVML for each snapshot like the cron job does
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-B', '--db', type=str, default=__DB__)
+    ag.add_argument('-i', '--interval', type=int, default=60)
+    ag = ag.parse_args(argv)
+
+    try:
+        from client import NvmlSampler
+        sampler = NvmlSampler(socket.gethostname(), nprocs=True)
+    except Exception as e:
+        cprint(f'cannot query NVML in-process ({e!r}), using gpustat', 'yellow')
+        sampler = None
+    conn = __connect(ag.db)
+    while True:
+        # align the snapshots to the interval, like cron does
+        time.sleep(ag.interval - time.time() % ag.interval)
+        stamp = int(time.time())
+        __insert_snapshot(conn, stamp, __collect(sampler))
+
+
+def __query_stat(conn: sqlite3.Connection, span: str, host: str = None) -> tuple:
+    '''
+    Return the (system, per-user) averages over the span. With a host,
+    from its snapshots in the central database, which has no rollups.
+    '''
     c = conn.cursor()
-    for (k, v) in counter.items():
-        c.execute(
-            f'''INSERT INTO userwatch VALUES ({stamp}, "{k}", {v}, {vram_occupy[k]})''')
-    c.execute(
-        f'''INSERT INTO gpuwatch VALUES ({stamp}, {gpu_util}, {vram_ratio})''')
-    conn.commit()
-    conn.close()
+    stamp_lower = int(time.time()) - __SPANS__[span]
+    rollup = __SPAN_ROLLUP__.get(span) if host is None else None
+    where = '' if host is None else 'host = ? AND '
+    hosts = () if host is None else (host,)
+    if rollup is None:
+        # Query the database : gpuwatch
+        count, gpu_util, vram_ratio = c.execute(
+            f'''SELECT COUNT(*), AVG(gpu_util), AVG(vmem_ratio) FROM gpuwatch WHERE {where}time > ?''',
+            (*hosts, stamp_lower)).fetchone()
+        # Query the database : userwatch
+        users = c.execute(
+            f'''SELECT name, COUNT(*), AVG(processes), AVG(vmem_occupy)
+            FROM userwatch WHERE {where}time > ? GROUP BY name ORDER BY MIN(time)''',
+            (*hosts, stamp_lower)).fetchall()
+    else:
+        # long spans are answered from the rollups, the raw snapshots
+        # may have been removed by the compact command
+        stamp_lower -= stamp_lower % __ROLLUPS__[rollup]
+        count, gpu_util, vram_ratio = c.execute(
+            f'''SELECT SUM(n), SUM(gpu_util_sum) / SUM(n), SUM(vmem_ratio_sum) / SUM(n)
+            FROM gpuwatch_{rollup} WHERE bucket >= ?''', (stamp_lower,)).fetchone()
+        users = c.execute(
+            f'''SELECT name, SUM(n), 1.0 * SUM(processes_sum) / SUM(n), SUM(vmem_occupy_sum) / SUM(n)
+            FROM userwatch_{rollup} WHERE bucket >= ? GROUP BY name ORDER BY MIN(bucket)''',
+            (stamp_lower,)).fetchall()
+    gpuwatch = {'gpu_util': gpu_util, 'vram_ratio': vram_ratio} if count else {}
+    userstat = dict()
+    for (user, cumtime, processes, vram_occupy) in users:
+        userstat[user] = {'cumtime': cumtime, 'processes': processes,
+                          'vram_occupy': vram_occupy}
+    return gpuwatch, userstat
+
+
+def __query_series(conn: sqlite3.Connection, span: str, host: str = None) -> tuple:
+    '''
+    Return the (time, gpu_util, vram_ratio) series over the span, as numpy
+    arrays. With a host, from the central database, bucketed like the rollups.
+    '''
+    import numpy as np
+    stamp_lower = int(time.time()) - __SPANS__[span]
+    rollup = __SPAN_ROLLUP__.get(span)
+    if host is not None:
+        width = __ROLLUPS__[rollup] if rollup is not None else 1
+        series = conn.execute(f'''SELECT time - time % {width}, AVG(gpu_util), AVG(vmem_ratio)
+                              FROM gpuwatch WHERE host = ? AND time > ? GROUP BY 1 ORDER BY 1''',
+                              (host, stamp_lower))
+    elif rollup is None:
+        series = conn.execute('''SELECT time, gpu_util, vmem_ratio FROM gpuwatch
+                              WHERE time > ? ORDER BY time''', (stamp_lower,))
+    else:
+        stamp_lower -= stamp_lower % __ROLLUPS__[rollup]
+        series = conn.execute(f'''SELECT bucket, gpu_util_sum / n, vmem_ratio_sum / n
+                              FROM gpuwatch_{rollup} WHERE bucket >= ? ORDER BY bucket''',
+                              (stamp_lower,))
+    series = np.array(series.fetchall(), dtype=np.float64).reshape(-1, 3)
+    return series[:, 0], series[:, 1], series[:, 2]
+
+
+def __envelope(stamps, values, buckets: int) -> tuple:
+    '''
+    Downsample a time series sorted by time into equal-width time buckets,
+    returning the (time, min, mean, max) of every bucket. Empty buckets are
+    NaN, so that the gaps are not drawn.
+
+    >>> import numpy as np
+    >>> t, lo, mean, hi = __envelope(np.array([0., 1., 2., 3., 8., 9.]),
+    ...                              np.array([1., 3., 2., 2., 5., 7.]), 5)
+    >>> t.tolist(), lo.tolist()[:2], mean.tolist()[:2], hi.tolist()[:2]
+    ([0.9, 2.7, 4.5, 6.3, 8.1], [1.0, 2.0], [2.0, 2.0], [3.0, 2.0])
+    >>> np.isnan(mean).tolist()
+    [False, False, True, True, False]
+    '''
+    import numpy as np
+    lower, upper = stamps[0], stamps[-1]
+    width = max(upper - lower, 1) / buckets
+    index = np.minimum(((stamps - lower) / width).astype(np.int64), buckets - 1)
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    count = np.diff(np.r_[starts, len(index)])
+    lo, mean, hi = (np.full(buckets, np.nan) for _ in range(3))
+    lo[index[starts]] = np.minimum.reduceat(values, starts)
+    mean[index[starts]] = np.add.reduceat(values, starts) / count
+    hi[index[starts]] = np.maximum.reduceat(values, starts)
+    return lower + width * (np.arange(buckets) + 0.5), lo, mean, hi
+
+
+def __print_stat(span: str, gpuwatch: dict, userstat: dict,
+                 no_user: bool = False, no_system: bool = False) -> None:
+    cprint(f':: GPU Usage Statistics (in the past {span})', 'yellow')
+    if not no_system:
+        cprint('SYSTEM |'.rjust(16), 'red', end=' ')
+        for (k, v) in gpuwatch.items():
+            print(f'{k}=', colored(str('%7.2f' % v), 'cyan'), end=' ')
+        print()
+    if not no_user:
+        for (k, v) in userstat.items():
+            cprint(f'{k} |'.rjust(16), 'blue', end=' ')
+            for attr in sorted(v.keys()):
+                print(f'{attr}=', colored(str('%8.2f' % v[attr]), 'cyan'), end=' ')
+            print()
+
+
+def __plot_figure(stamps, gpu_util, vram_ratio, title: str,
+                  rasterize: bool = False):
+    '''
+    Plot the series into a new matplotlib figure. Series longer than the
+    pixel columns of the figure are drawn as a min/mean/max envelope.
+    '''
+    import matplotlib as plt
+    import matplotlib.pyplot
+    import numpy as np
+    # configuring matplotlib
+    plt.pyplot.style.use('bmh')
+    plt.pyplot.rcParams['font.sans-serif'] = 'Noto Sans'
+    plt.pyplot.rcParams['font.weight'] = 'normal'
+    # date formatter
+    date_fmt = '%y-%m-%d %H:%M:%S'
+    date_formatter = plt.dates.DateFormatter(date_fmt)
+
+    height = 5
+    width = min(__PLOT_WIDTH__, 5 * max(1, (1 + len(stamps) // (60*24))))
+    fig, ax = plt.pyplot.subplots(figsize=(width, height), dpi=__PLOT_DPI__)
+    ax.set_title(title + f' @ {time.ctime()}', fontweight='book')
+    ax2 = ax.twinx()
+    columns = width * __PLOT_DPI__
+    for (axis, values, color, label) in ((ax, gpu_util, 'crimson', 'gpu_util'),
+                                         (ax2, vram_ratio, 'indigo', 'vram_ratio')):
+        if len(stamps) > columns:
+            t, lo, mean, hi = __envelope(stamps, values, columns)
+            # offset the timezone to UTC+8
+            t = plt.dates.date2num((t + 3600*8).astype('datetime64[s]'))
+            axis.fill_between(t, lo, hi, color=color, alpha=0.25, linewidth=0,
+                              rasterized=rasterize)
+            axis.plot(t, mean, '-', color=color, label=label, rasterized=rasterize)
+        elif len(stamps):
+            # offset the timezone to UTC+8
+            t = plt.dates.date2num((stamps + 3600*8).astype('datetime64[s]'))
+            axis.plot(t, values, '.-', color=color, label=label, rasterized=rasterize)
+
+    ax.set(ylim=(0., 100.))
+    ax.grid(True)
+    ax.legend(loc='lower left')
+    ax.xaxis.set_major_formatter(date_formatter)
+
+    ax2.set(ylim=(0., 1.))
+    ax2.grid(True)
+    ax2.legend(loc='lower right')
+    ax2.xaxis.set_major_formatter(date_formatter)
+
+    fig.autofmt_xdate()
+    return fig
 
 
 def main_stat(argv):
     '''
     Print statistics by inspecting the database
     '''
-    __create_db_if_not_exist()
     ag = argparse.ArgumentParser()
     ag.add_argument('-B', '--db', type=str, default=__DB__)
     ag.add_argument('-s', '--span', type=str, default='day',
-                    choices=('hour', 'day', 'week', 'month', 'season'))
+                    choices=tuple(__SPANS__.keys()))
     ag.add_argument('--plot', action='store_true')
     ag.add_argument('--plot_title', type=str, default=f'gpuwatch.py')
+    ag.add_argument('--plot_output', type=str, default='gpuwatch.svg',
+                    help='the format follows the extension, e.g. .svg, .png, .pdf')
+    ag.add_argument('--rasterize', action='store_true',
+                    help='embed the curves as a bitmap in .svg/.pdf outputs')
     ag.add_argument('--no_user', action='store_true')
     ag.add_argument('--no_system', action='store_true')
     ag = ag.parse_args(argv)
     # Connect to database
-    conn = sqlite3.connect(ag.db)
-    c = conn.cursor()
-    stamp_lower = time.time() - {'hour': 3600, 'day': 3600*24, 'week': 3600*24*7,
-                                 'month': 3600*24*30, 'season': 3600*24*90}[ag.span]
-    # Query the database : userwatch
-    gpuwatch = collections.defaultdict(list)
-    stamps = list()
-    for row in c.execute(f'''SELECT * FROM gpuwatch WHERE time > {stamp_lower}'''):
-        stamp, gpu_util, vram_ratio = row
-        stamps.append(float(stamp))
-        gpuwatch['gpu_util'].append(gpu_util)
-        gpuwatch['vram_ratio'].append(vram_ratio)
-    # Query the database : gpuwatch
-    userstat = collections.defaultdict(lambda: collections.defaultdict(list))
-    for row in c.execute(f'''SELECT * FROM userwatch WHERE time > {stamp_lower}'''):
-        stamp, user, processes, vram_occupy = row
-        userstat[user]['cumtime'].append(1)
-        userstat[user]['processes'].append(processes)
-        userstat[user]['vram_occupy'].append(vram_occupy)
+    conn = __connect(ag.db)
+    gpuwatch, userstat = __query_stat(conn, ag.span)
     # Printing
-    cprint(f':: GPU Usage Statistics (in the past {ag.span})', 'yellow')
-    if not ag.no_system:
-        cprint('SYSTEM |'.rjust(16), 'red', end=' ')
-        for (k, v) in gpuwatch.items():
-            print(f'{k}=', colored(str('%7.2f' %
-                                       statistics.mean(v)), 'cyan'), end=' ')
-        print()
-    if not ag.no_user:
-        for (k, v) in userstat.items():
-            cprint(f'{k} |'.rjust(16), 'blue', end=' ')
-            for attr in sorted(v.keys()):
-                if attr == 'cumtime':
-                    print(f'{attr}=', colored(str('%8.2f' %
-                                                  sum(v[attr])), 'cyan'), end=' ')
-                else:
-                    print(f'{attr}=', colored(str('%8.2f' %
-                                                  statistics.mean(v[attr])), 'cyan'), end=' ')
-            print()
+    __print_stat(ag.span, gpuwatch, userstat, ag.no_user, ag.no_system)
     # [optional] Plotting
     if ag.plot:
-        import matplotlib as plt
+        fig = __plot_figure(*__query_series(conn, ag.span), ag.plot_title,
+                            ag.rasterize)
+        fig.savefig(ag.plot_output)
+        cprint(f'Plot have been saved to {ag.plot_output}', 'yellow')
+
+
+def __fleet_load(path: str, span: str, host: str = None) -> tuple:
+    '''
+    Load the statistics and the series of one host, in a worker process,
+    from its own database or from the central one
+    '''
+    begin = time.perf_counter()
+    conn = __connect(path) if host is None else sqlite3.connect(path)
+    gpuwatch, userstat = __query_stat(conn, span, host)
+    series = __query_series(conn, span, host)
+    conn.close()
+    return gpuwatch, userstat, series, time.perf_counter() - begin
+
+
+def main_fleet(argv):
+    '''
+    Print the statistics of many per-host databases (as fetched by
+    Makefile.gpuwatch fetch_db), or of the hosts of the central database
+    (as filled by Makefile.gpuwatch sync_db), and plot them into a single
+    PDF file
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-g', '--glob', type=str, default='*_gpuwatch.db')
+    ag.add_argument('-C', '--central', type=str, default='',
+                    help='read the hosts of this central database instead, e.g. __fleet__.db')
+    ag.add_argument('-s', '--span', type=str, default='week',
+                    choices=tuple(__SPANS__.keys()))
+    ag.add_argument('-o', '--output', type=str, default='fleet.pdf')
+    ag.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    ag.add_argument('--no_plot', action='store_true')
+    ag.add_argument('--rasterize', action='store_true')
+    ag.add_argument('--no_user', action='store_true')
+    ag = ag.parse_args(argv)
+    import concurrent.futures
+    if ag.central:
+        conn = __connect_central(ag.central)
+        dbs = {host: (ag.central, host) for (host,) in
+               conn.execute('''SELECT host FROM sync ORDER BY host''')}
+        conn.close()
+    else:
+        dbs = {re.sub(r'_gpuwatch\.db$', '', os.path.basename(db)): (db, None)
+               for db in sorted(glob.glob(ag.glob))}
+    timing = collections.OrderedDict()
+    # Load every database in parallel
+    begin = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=ag.jobs) as pool:
+        futures = {host: pool.submit(__fleet_load, db, ag.span, central_host)
+                   for (host, (db, central_host)) in dbs.items()}
+        hosts = {host: f.result() for (host, f) in futures.items()}
+    timing['load'] = time.perf_counter() - begin
+    for (host, (gpuwatch, userstat, _, _)) in hosts.items():
+        cprint(f'{host}'.center(80, '-'), 'white')
+        __print_stat(ag.span, gpuwatch, userstat, ag.no_user)
+    # Plot every host as one page of the PDF
+    if not ag.no_plot:
+        begin = time.perf_counter()
+        import matplotlib
+        matplotlib.use('Agg')
         import matplotlib.pyplot
-        import numpy as np
-        # configuring matplotlib
-        plt.pyplot.style.use('bmh')
-        plt.pyplot.rcParams['font.sans-serif'] = 'Noto Sans'
-        plt.pyplot.rcParams['font.weight'] = 'normal'
-        # date formatter
-        date_fmt = '%y-%m-%d %H:%M:%S'
-        date_formatter = plt.dates.DateFormatter(date_fmt)
-        # offset the timezone to UTC+8
-        stamps = [x + 3600*8 for x in stamps]
-
-        height = 5
-        width = 5 * max(1, (1 + len(stamps) // (60*24)))
-        fig, ax = plt.pyplot.subplots(figsize=(width, height))
-        a = [float(x) for x in gpuwatch['gpu_util']]
-        b = [float(x) for x in gpuwatch['vram_ratio']]
-        t = plt.dates.epoch2num(stamps)
-        plt.pyplot.title(ag.plot_title + f' @ {time.ctime()}', fontweight='book')
-
-        ax.plot_date(t, a, '.-', color='crimson')
-        ax.set(ylim=(0., 100.))
-        ax.grid(True)
-        ax.legend(['gpu_util'], loc='lower left')
-        ax.xaxis.set_major_formatter(date_formatter)
-
-        ax2 = ax.twinx()
-        ax2.plot_date(t, b, '.-', color='indigo')
-        ax2.set(ylim=(0., 1.))
-        ax2.grid(True)
-        ax2.legend(['vram_ratio'], loc='lower right')
-        ax2.xaxis.set_major_formatter(date_formatter)
-
-        fig.autofmt_xdate()
-        plt.pyplot.savefig('gpuwatch.svg')
-        cprint('Plot have been saved to gpuwatch.svg', 'yellow')
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(ag.output) as pdf:
+            for (host, (_, _, series, _)) in hosts.items():
+                fig = __plot_figure(*series, host, ag.rasterize)
+                pdf.savefig(fig)
+                matplotlib.pyplot.close(fig)
+        timing['plot'] = time.perf_counter() - begin
+    # Timing report
+    if hosts:
+        load = [x[3] for x in hosts.values()]
+        cprint(f':: Timing ({len(hosts)} hosts, {ag.jobs} jobs)', 'yellow')
+        for (k, v) in timing.items():
+            print(f'{k} |'.rjust(16), colored('%8.3f s' % v, 'cyan'))
+        print('load/host |'.rjust(16),
+              'mean', colored('%.3f s' % statistics.mean(load), 'cyan'),
+              'max', colored('%.3f s' % max(load), 'cyan'),
+              'sum', colored('%.3f s' % sum(load), 'cyan'))
+    if not ag.no_plot:
+        cprint(f'Plots have been saved to {ag.output}', 'yellow')
+
+
+def main_compact(argv):
+    '''
+    Remove the raw snapshots and hourly rollups past their horizon, the
+    daily rollups are kept. Then give the free pages back to the system.
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-B', '--db', type=str, default=__DB__)
+    # the shorter spans are read from the raw snapshots, and the longest
+    # span read from the hourly rollups bounds their horizon
+    hourly = max(__SPANS__[s] for (s, r) in __SPAN_ROLLUP__.items() if r == 'hourly')
+    ag.add_argument('--keep', type=str, default='season', choices=tuple(__SPAN_ROLLUP__.keys()),
+                    help='horizon of the raw snapshots')
+    ag.add_argument('--keep_hourly', type=str, default='year',
+                    choices=tuple(s for s in __SPAN_ROLLUP__ if __SPANS__[s] >= hourly),
+                    help='horizon of the hourly rollups')
+    ag = ag.parse_args(argv)
+    conn = __connect(ag.db)
+    now = int(time.time())
+    with conn:
+        for table in ('gpuwatch', 'userwatch'):
+            n = conn.execute(f'''DELETE FROM {table} WHERE time < ?''',
+                             (now - __SPANS__[ag.keep],)).rowcount
+            cprint(f'{table}: removed {n} snapshots older than a {ag.keep}', 'yellow')
+            n = conn.execute(f'''DELETE FROM {table}_hourly WHERE bucket < ?''',
+                             (now - __SPANS__[ag.keep_hourly],)).rowcount
+            cprint(f'{table}_hourly: removed {n} rollups older than a {ag.keep_hourly}', 'yellow')
+    if conn.execute('''PRAGMA auto_vacuum''').fetchone()[0] != 2:
+        # databases created before the rollups need one full vacuum
+        # to switch to incremental vacuum
+        conn.execute('''PRAGMA auto_vacuum = INCREMENTAL''')
+        conn.execute('''VACUUM''')
+    else:
+        # each step of the statement frees one page, and execute() only
+        # steps it once since it has no result columns
+        conn.executescript('''PRAGMA incremental_vacuum;''')
+    conn.close()
+    cprint(f'{ag.db}: {os.path.getsize(ag.db)} bytes', 'yellow')
+
+
+def __export_rows(conn: sqlite3.Connection, since: int):
+    '''
+    Yield the snapshots after the given time, as ('g', time, gpu_util,
+    vmem_ratio) and ('u', time, name, processes, vmem_occupy) tuples
+    '''
+    # read both tables from the same snapshot of the database
+    conn.execute('''BEGIN''')
+    try:
+        for row in conn.execute('''SELECT * FROM gpuwatch WHERE time > ? ORDER BY time''', (since,)):
+            yield ('g', *row)
+        for row in conn.execute('''SELECT * FROM userwatch WHERE time > ? ORDER BY time''', (since,)):
+            yield ('u', *row)
+    finally:
+        conn.execute('''ROLLBACK''')
+
+
+def main_export(argv):
+    '''
+    Print the snapshots after a high-water mark as NDJSON, for merge
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-B', '--db', type=str, default=__DB__)
+    ag.add_argument('--since', type=int, default=0,
+                    help='only export the snapshots after this time')
+    ag = ag.parse_args(argv)
+    conn = __connect(ag.db)
+    for row in __export_rows(conn, ag.since):
+        sys.stdout.write(json.dumps(row, separators=(',', ':')) + '\n')
+    conn.close()
+
+
+def __connect_central(path: str) -> sqlite3.Connection:
+    '''
+    Open the central database holding the snapshots of many hosts
+    '''
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+    CREATE TABLE IF NOT EXISTS userwatch (host text, time integer, name text, processes integer, vmem_occupy real);
+    CREATE TABLE IF NOT EXISTS gpuwatch (host text, time integer, gpu_util real, vmem_ratio real);
+    CREATE TABLE IF NOT EXISTS sync (host text PRIMARY KEY, hwm integer);
+    CREATE INDEX IF NOT EXISTS userwatch_host_time ON userwatch (host, time);
+    CREATE INDEX IF NOT EXISTS userwatch_host_name_time ON userwatch (host, name, time);
+    CREATE INDEX IF NOT EXISTS gpuwatch_host_time ON gpuwatch (host, time);
+    ''')
+    return conn
+
+
+def main_merge(argv):
+    '''
+    Append the output of export (or the new snapshots of a per-host
+    database) into the central database, remembering the high-water mark
+    of each host
+    '''
+    ag = argparse.ArgumentParser()
+    ag.add_argument('-B', '--db', type=str, default='__fleet__.db',
+                    help='the central database')
+    ag.add_argument('--host', type=str, required=True)
+    ag.add_argument('--hwm', action='store_true',
+                    help='print the high-water mark of the host and exit')
+    ag.add_argument('--from_db', type=str, default='',
+                    help='read from a per-host database instead of stdin')
+    ag.add_argument('input', type=str, nargs='?', default='-')
+    ag = ag.parse_args(argv)
+    conn = __connect_central(ag.db)
+    hwm = conn.execute('''SELECT hwm FROM sync WHERE host = ?''', (ag.host,)).fetchone()
+    hwm = 0 if hwm is None else hwm[0]
+    if ag.hwm:
+        print(hwm)
+        return
+    if ag.from_db:
+        rows = __export_rows(__connect(ag.from_db), hwm)
+    else:
+        lines = sys.stdin if ag.input == '-' else open(ag.input)
+        rows = (json.loads(line) for line in lines if line.strip())
+    count = collections.Counter()
+    last = hwm
+    with conn:
+        for (table, stamp, *row) in rows:
+            # the export may overlap what was merged before
+            if stamp <= hwm:
+                continue
+            if table == 'g':
+                conn.execute('''INSERT INTO gpuwatch VALUES (?, ?, ?, ?)''', (ag.host, stamp, *row))
+            else:
+                conn.execute('''INSERT INTO userwatch VALUES (?, ?, ?, ?, ?)''', (ag.host, stamp, *row))
+            count[table] += 1
+            last = max(last, stamp)
+        conn.execute('''INSERT OR REPLACE INTO sync VALUES (?, ?)''', (ag.host, last))
+    cprint(f'{ag.host}: merged {count["g"]} snapshots ({count["u"]} user rows), '
+           f'high-water mark {last}', 'yellow', file=sys.stderr)
 
 
 def main_svgreduce(argv):
@@ -0,0 +1,287 @@
+'''
+Time-series history of the GPU usage received by server.py.
+Copyright (C) 2023, Mo Zhou <lumin@debian.org>
+MIT/Expat License
+
+The samples are queued in memory and written in batches into a SQLite
+database by a background thread. The same thread rolls them up into
+1-minute, 15-minute and 1-hour tiers keeping min/mean/max, and expires
+the raw samples and each tier on its own retention schedule.
+
+The most recent samples are also kept in memory in fixed-size ring
+buffers, for window statistics that do not touch the disk.
+'''
+import math
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+import rich
+console = rich.get_console()
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# (bucket width in seconds, retention in seconds); width 0 is the raw samples
+TIERS = ((0, 3600*24),
+         (60, 3600*24*7),
+         (900, 3600*24*90),
+         (3600, 3600*24*730))
+# at most this many points are returned for a query
+MAX_POINTS = 1500
+# a GPU at or below this utilization.gpu is considered idle
+IDLE_UTIL = 2
+
+
+class HistoryStore(object):
+    '''
+    Per (host, GPU index) history of utilization.gpu and memory.used.
+    '''
+
+    def __init__(self, path: str, flush_interval: float = 10.0,
+                 expire_interval: float = 3600.0, maxlen: int = 100000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.expire_interval = expire_interval
+        # samples not written yet, the oldest are dropped if the disk stalls
+        self.pending = deque(maxlen=maxlen)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_expire = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('''PRAGMA journal_mode=WAL''')
+        conn.execute('''PRAGMA synchronous=NORMAL''')
+        conn.execute(
+            '''CREATE TABLE IF NOT EXISTS raw (host text, gpu integer, time integer, util integer, mem integer)''')
+        conn.execute(
+            '''CREATE INDEX IF NOT EXISTS raw_host_gpu_time ON raw (host, gpu, time)''')
+        for (width, _) in TIERS[1:]:
+            conn.execute(
+                f'''CREATE TABLE IF NOT EXISTS tier_{width} (host text, gpu integer, bucket integer, n integer,
+                util_min integer, util_sum integer, util_max integer,
+                mem_min integer, mem_sum integer, mem_max integer,
+                PRIMARY KEY (host, gpu, bucket)) WITHOUT ROWID''')
+        return conn
+
+    def append(self, data) -> None:
+        '''
+        queue the per-GPU values of a submission
+        '''
+        stamp = int(data.get('query_time') or time.time())
+        hostname = data['hostname']
+        for gpu in data['gpus']:
+            self.pending.append((hostname, gpu['index'], stamp,
+                                 gpu['utilization.gpu'], gpu['memory.used']))
+        if self.thread is None:
+            self.start()
+
+    def start(self) -> None:
+        '''
+        start the writer thread. This is done lazily at the first sample,
+        so that the thread lives in the process that serves the requests.
+        '''
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__loop, daemon=True)
+                self.thread.start()
+
+    def __loop(self) -> None:
+        conn = self.connect()
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush(conn)
+                if time.time() - self.last_expire > self.expire_interval:
+                    self.expire(conn)
+            except sqlite3.Error as e:
+                console.log('history:', repr(e))
+
+    def flush(self, conn: sqlite3.Connection) -> int:
+        '''
+        write the queued samples and merge them into the rollup tiers
+        '''
+        rows = []
+        while self.pending:
+            rows.append(self.pending.popleft())
+        if not rows:
+            return 0
+        with conn:
+            conn.executemany('''INSERT INTO raw VALUES (?, ?, ?, ?, ?)''', rows)
+            for (width, _) in TIERS[1:]:
+                # aggregate the batch first, then merge one row per bucket
+                buckets = dict()
+                for (host, gpu, stamp, util, mem) in rows:
+                    key = (host, gpu, stamp - stamp % width)
+                    b = buckets.get(key)
+                    if b is None:
+                        buckets[key] = [1, util, util, util, mem, mem, mem]
+                    else:
+                        b[0] += 1
+                        b[1], b[2], b[3] = min(b[1], util), b[2] + util, max(b[3], util)
+                        b[4], b[5], b[6] = min(b[4], mem), b[5] + mem, max(b[6], mem)
+                conn.executemany(
+                    f'''INSERT INTO tier_{width} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (host, gpu, bucket) DO UPDATE SET
+                    n = n + excluded.n,
+                    util_min = min(util_min, excluded.util_min),
+                    util_sum = util_sum + excluded.util_sum,
+                    util_max = max(util_max, excluded.util_max),
+                    mem_min = min(mem_min, excluded.mem_min),
+                    mem_sum = mem_sum + excluded.mem_sum,
+                    mem_max = max(mem_max, excluded.mem_max)''',
+                    [k + tuple(v) for (k, v) in buckets.items()])
+        return len(rows)
+
+    def expire(self, conn: sqlite3.Connection) -> None:
+        '''
+        drop the raw samples and rollups older than their retention
+        '''
+        now = time.time()
+        with conn:
+            for (width, retention) in TIERS:
+                if width == 0:
+                    conn.execute('''DELETE FROM raw WHERE time < ?''', (now - retention,))
+                else:
+                    conn.execute(f'''DELETE FROM tier_{width} WHERE bucket < ?''',
+                                 (now - retention,))
+        self.last_expire = now
+
+    def query(self, hostname: str, index: int, span: float) -> dict:
+        '''
+        return the history of a GPU over the last span seconds, from the
+        finest tier that covers the span within MAX_POINTS buckets. The
+        buckets of the coarsest tier are merged when there would be more.
+        '''
+        for (width, retention) in TIERS:
+            if retention >= span and (width == 0 and span <= 3600
+                                      or width > 0 and span / width <= MAX_POINTS):
+                break
+        if width > 0:
+            # one more bucket for the one since falls in
+            tier, width = width, width * math.ceil(span / width / (MAX_POINTS - 1))
+        since = time.time() - span
+        conn = self.connect()
+        try:
+            if width == 0:
+                rows = conn.execute(
+                    '''SELECT time, util, util, util, mem, mem, mem FROM raw
+                    WHERE host = ? AND gpu = ? AND time >= ? ORDER BY time''',
+                    (hostname, index, since)).fetchall()
+            else:
+                rows = conn.execute(
+                    f'''SELECT bucket - bucket % ? AS b, min(util_min),
+                    1.0 * sum(util_sum) / sum(n), max(util_max),
+                    min(mem_min), 1.0 * sum(mem_sum) / sum(n), max(mem_max) FROM tier_{tier}
+                    WHERE host = ? AND gpu = ? AND bucket >= ? GROUP BY b ORDER BY b''',
+                    (width, hostname, index, since - since % width)).fetchall()
+        finally:
+            conn.close()
+        return {
+                'host': hostname,
+                'gpu': index,
+                'tier': width,
+                'columns': ['time', 'util_min', 'util_mean', 'util_max',
+                            'mem_min', 'mem_mean', 'mem_max'],
+                'points': rows,
+                }
+
+
+class RingBuffer(object):
+    '''
+    Fixed-size, array-backed ring of (time, utilization.gpu, memory.used)
+    samples of one GPU, costing 9 bytes per sample.
+    '''
+    __slots__ = ('times', 'util', 'mem', 'head', 'count')
+
+    def __init__(self, size: int):
+        self.times = array('I', bytes(4 * size))
+        self.util = array('B', bytes(size))
+        self.mem = array('I', bytes(4 * size))
+        self.head = 0
+        self.count = 0
+
+    def append(self, stamp: float, util: int, mem: int) -> None:
+        self.times[self.head] = int(stamp)
+        self.util[self.head] = min(max(int(util), 0), 255)
+        self.mem[self.head] = int(mem)
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def oldest(self) -> int:
+        return self.times[(self.head - self.count) % len(self.times)]
+
+    def stats(self, seconds: float, now: float = None) -> dict:
+        '''
+        window statistics over the samples of the last given seconds,
+        or None if there is no sample in the window
+        '''
+        since = (time.time() if now is None else now) - seconds
+        # read once, append() may bump it meanwhile
+        count = self.count
+        if np is not None:
+            times = np.frombuffer(self.times, dtype=np.uint32)[:count]
+            mask = times >= since
+            util = np.frombuffer(self.util, dtype=np.uint8)[:count][mask]
+            mem = np.frombuffer(self.mem, dtype=np.uint32)[:count][mask]
+            if len(util) == 0:
+                return None
+            return {
+                    'n': len(util),
+                    'util_mean': float(util.mean()),
+                    'util_p95': int(np.percentile(util, 95, method='lower')),
+                    'idle_fraction': float((util <= IDLE_UTIL).mean()),
+                    'mem_mean': float(mem.mean()),
+                    'mem_max': int(mem.max()),
+                    }
+        window = [i for i in range(count) if self.times[i] >= since]
+        if not window:
+            return None
+        util = sorted(self.util[i] for i in window)
+        mem = [self.mem[i] for i in window]
+        return {
+                'n': len(util),
+                'util_mean': sum(util) / len(util),
+                'util_p95': util[int(0.95 * (len(util) - 1))],
+                'idle_fraction': sum(1 for u in util if u <= IDLE_UTIL) / len(util),
+                'mem_mean': sum(mem) / len(mem),
+                'mem_max': max(mem),
+                }
+
+
+class RecentHistory(object):
+    '''
+    RingBuffer of the recent samples of every (host, GPU index), for the
+    sparklines and "last hour" views that should not touch the disk.
+    Memory is bounded by hosts x GPUs x size x 9 bytes.
+    '''
+
+    def __init__(self, size: int = 720):
+        self.size = size
+        self.rings = dict()
+
+    def append(self, hostname: str, stamp: float, data) -> None:
+        for gpu in data['gpus']:
+            key = (hostname, gpu['index'])
+            ring = self.rings.get(key)
+            if ring is None:
+                ring = self.rings[key] = RingBuffer(self.size)
+            ring.append(stamp, gpu['utilization.gpu'], gpu['memory.used'])
+
+    def stats(self, hostname: str, index: int, seconds: float) -> dict:
+        ring = self.rings.get((hostname, index))
+        return None if ring is None else ring.stats(seconds)
+
+    def idle_for(self, hostname: str, index: int, seconds: float) -> bool:
+        '''
+        whether the GPU was idle during all of the last given seconds
+        '''
+        ring = self.rings.get((hostname, index))
+        if ring is None or ring.count == 0 or ring.oldest() > time.time() - seconds:
+            return False
+        stats = ring.stats(seconds)
+        # no sample in the window when the host stopped submitting
+        return stats is not None and stats['idle_fraction'] == 1.0
@@ -0,0 +1,155 @@
+'''
+Low-overhead self-instrumentation of server.py.
+Copyright (C) 2023, Mo Zhou <lumin@debian.org>
+MIT/Expat License
+
+Latencies are counted into fixed histogram buckets, which costs two
+perf_counter() calls and a bisect per observation, so that it can stay on
+in production. The stack sampler is only run on demand, for a bounded time.
+'''
+import bisect
+import collections
+import functools
+import gc
+import sys
+import threading
+import time
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram(object):
+    '''
+    Latency histogram over BUCKETS
+    '''
+    __slots__ = ('counts', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        '''
+        upper bound of the bucket holding the q-quantile
+        '''
+        total = sum(self.counts)
+        rank, seen = q * total, 0
+        for (bound, count) in zip(BUCKETS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return 0.0
+
+    def as_dict(self) -> dict:
+        count = sum(self.counts)
+        return {
+                'count': count,
+                'sum': self.sum,
+                'mean': self.sum / count if count else 0.0,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'max': self.max,
+                'buckets': {str(b): c for (b, c) in zip(BUCKETS, self.counts) if c},
+                }
+
+
+class Instruments(object):
+    '''
+    Histograms and counters of the routes, render phases and GC pauses
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.routes = collections.defaultdict(Histogram)
+        self.phases = collections.defaultdict(Histogram)
+        self.gc = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.gc_begin = None
+
+    def observe_route(self, route: str, seconds: float, bytes_in: int,
+                      bytes_out: int) -> None:
+        self.routes[route].observe(seconds)
+        self.counters[f'{route} bytes_in'] += bytes_in
+        self.counters[f'{route} bytes_out'] += bytes_out
+
+    def phase(self, name: str):
+        '''
+        decorator timing every call of a function as a render phase
+        '''
+        histogram = self.phases[name]
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                begin = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - begin)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] += value
+
+    def gc_callback(self, phase: str, info: dict) -> None:
+        if phase == 'start':
+            self.gc_begin = time.perf_counter()
+        elif self.gc_begin is not None:
+            self.gc[f'gen{info["generation"]}'].observe(time.perf_counter() - self.gc_begin)
+            self.counters['gc collected'] += info['collected']
+            self.gc_begin = None
+
+    def install_gc_callback(self) -> None:
+        if self.gc_callback not in gc.callbacks:
+            gc.callbacks.append(self.gc_callback)
+
+    def as_dict(self) -> dict:
+        return {
+                'uptime': time.time() - self.started,
+                'routes': {k: v.as_dict() for (k, v) in sorted(self.routes.items())},
+                'phases': {k: v.as_dict() for (k, v) in sorted(self.phases.items())},
+                'gc': {k: v.as_dict() for (k, v) in sorted(self.gc.items())},
+                'counters': dict(sorted(self.counters.items())),
+                }
+
+
+def threads_sampleable() -> bool:
+    '''
+    whether the requests are served by OS threads, which sample_stacks()
+    can see. The greenlets of the gevent uWSGI unit are not.
+    '''
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is None or not monkey.is_module_patched('threading')
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> str:
+    '''
+    sample the stacks of all the other threads for the given time, and
+    return them in the collapsed format of flamegraph.pl ("a;b;c count").
+    It blocks the calling thread, which must not be the one to profile.
+    '''
+    me = threading.get_ident()
+    stacks = collections.Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join(f'{stack} {count}\n' for (stack, count) in stacks.most_common())
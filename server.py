@@ -9,21 +9,41 @@ Usage
 At the server side: `$ python3 server.py`
 If you want to make this robust, just use Makefile.server to
 install the systemd service unit in the user mode.
+For thousands of clients, see the asyncio mode in aserver.py.
 '''
 import gc
 import os
+import sys
 import time
+import threading
 import argparse
 import datetime
-from collections import defaultdict
+import bisect
+import hmac
+import heapq
+from collections import defaultdict, Counter, deque
 import gzip
 import json
 import rich
 console = rich.get_console()
-from flask import Flask, request
-from flask import send_from_directory
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from collections import OrderedDict
+from flask import Flask, request, g
+from history import HistoryStore, RecentHistory
+from state import make_state
+from instrument import Instruments, sample_stacks, threads_sampleable
 app = Flask(__name__)
 
+# version of the payload layout, sent by client.py in binary formats
+SCHEMA_VERSION = 1
+
 HEADER = '''
 <!--
 This webpage is automatically generated by server.py from https://github.com/cdluminate/gpu-load-watcher
@@ -35,7 +55,7 @@ License: MIT/Expat
   <head>
     <meta charset="utf-8">
     <meta name="viewport" content="width=device-width, initial-scale=1">
-    <meta http-equiv="refresh" content="7" />
+    <noscript><meta http-equiv="refresh" content="7" /></noscript>
     <title>Mo's GPU Watcher</title>
     <link rel="icon" type="image/x-icon" href="/favicon.ico">
     <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css" rel="stylesheet" integrity="sha384-T3c6CoIi6uLrA9TneNEoa7RxnatzjcDSCmG1MXxSR1GAsXEV/Dwwykc2MPK8M2HN" crossorigin="anonymous">
@@ -56,7 +76,7 @@ License: MIT/Expat
           <a class="nav-link dropdown-toggle" href="#" role="button" data-bs-toggle="dropdown" aria-expanded="false">
             Statistics
           </a>
-          <ul class="dropdown-menu">
+          <ul class="dropdown-menu" id="stat-clients">
             @STAT_CLIENTS@
           </ul>
         </li>
@@ -72,7 +92,7 @@ License: MIT/Expat
           <a class="nav-link dropdown-toggle" href="#" role="button" data-bs-toggle="dropdown" aria-expanded="false">
             Finder
           </a>
-          <ul class="dropdown-menu">
+          <ul class="dropdown-menu" id="find-clients">
             @FIND_CLIENTS@
           </ul>
         </li>
@@ -111,6 +131,51 @@ document.addEventListener('keydown',
         if (key == 86)
             toggle_navbar();
     })
+
+// keep the sync age badges ticking between updates
+function tick_lastsync() {
+    var now = Date.now() / 1000;
+    document.querySelectorAll('[data-lastsync]').forEach(function(x) {
+        var since = Math.floor(now - parseFloat(x.dataset.lastsync));
+        if (x.dataset.kind === 'client') {
+            x.textContent = since;
+            x.className = since <= 60 ? 'badge text-bg-success' : 'badge text-bg-danger';
+        } else if (since > 60) {
+            x.textContent = 'Last Sync: ' + since + ' (ERROR: Client Disconnected)';
+            x.className = 'badge bg-danger';
+        } else {
+            x.textContent = 'Last Sync: ' + since + ' (OK)';
+            x.className = 'badge bg-success';
+        }
+    });
+}
+tick_lastsync();
+setInterval(tick_lastsync, 1000);
+
+// patch the page in place with the updates pushed by the server
+if (window.EventSource) {
+    var source = new EventSource('/events');
+    source.onmessage = function(e) {
+        var update = JSON.parse(e.data);
+        var host = document.getElementById('host-' + update.hostname);
+        if (host) {
+            host.outerHTML = update.html;
+        } else if (window.location.pathname === '/') {
+            window.location.reload();
+        }
+        document.getElementById('stat-clients').innerHTML = update.stat;
+        document.getElementById('find-clients').innerHTML = update.find;
+        document.querySelectorAll('[data-kind="client"][data-hostname="' + update.hostname + '"]').forEach(function(x) {
+            x.dataset.lastsync = update.lastsync;
+        });
+        tick_lastsync();
+    };
+    source.addEventListener('reload', function(e) {
+        window.location.reload();
+    });
+} else {
+    setTimeout(function() { window.location.reload(); }, 7000);
+}
 </script>
 
   </body>
@@ -118,13 +183,195 @@ document.addEventListener('keydown',
 '''
 
 
+class EventLog(object):
+    '''
+    Fan-out of per-host updates to the Server-Sent Events subscribers.
+    Subscribers only keep a cursor into a bounded log and wait on a shared
+    condition, so publishing costs the same for any number of subscribers.
+    The condition is cooperative under gevent monkey patching, so uWSGI
+    can serve the streams from greenlets instead of threads.
+    '''
+
+    def __init__(self, maxlen: int = 256):
+        self.events = deque(maxlen=maxlen)
+        self.seq = 0
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+    def subscribe(self, delta: int) -> None:
+        with self.cond:
+            self.subscribers += delta
+
+    def publish(self, event: str) -> None:
+        with self.cond:
+            self.seq += 1
+            self.events.append((self.seq, event))
+            self.cond.notify_all()
+
+    def since(self, seq: int) -> list:
+        '''
+        return the events after seq, or None if some of them were dropped
+        '''
+        with self.cond:
+            if seq > self.seq or self.events and seq < self.events[0][0] - 1:
+                return None
+            return [(s, e) for (s, e) in self.events if s > seq]
+
+    def wait(self, seq: int, timeout: float) -> list:
+        with self.cond:
+            if self.seq <= seq:
+                self.cond.wait(timeout)
+        return self.since(seq)
+
+
+class CompactRecord(object):
+    '''
+    Base of the compact records replacing the decoded request bodies. The
+    fields are read with the keys of the submitted JSON, e.g.
+    gpu['memory.used'], so that the renderers see no difference. Unknown
+    fields are kept in extra.
+    '''
+    __slots__ = ('extra',)
+    # JSON key -> attribute
+    FIELDS = {}
+
+    def __getitem__(self, key: str):
+        attr = self.FIELDS.get(key)
+        if attr is not None:
+            return getattr(self, attr)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self) -> dict:
+        data = {key: getattr(self, attr) for (key, attr) in self.FIELDS.items()}
+        return data if self.extra is None else data | self.extra
+
+
+class GpuRecord(CompactRecord):
+    '''
+    Compact per-GPU part of a record, with the model and user names interned
+    '''
+    __slots__ = ('index', 'name', 'util', 'mem_used', 'mem_total', 'users')
+    FIELDS = {'index': 'index', 'name': 'name', 'utilization.gpu': 'util',
+              'memory.used': 'mem_used', 'memory.total': 'mem_total', 'users': 'users'}
+
+    def __init__(self, gpu: dict):
+        gpu = dict(gpu)
+        self.index = gpu.pop('index')
+        self.name = sys.intern(gpu.pop('name'))
+        self.util = gpu.pop('utilization.gpu')
+        self.mem_used = gpu.pop('memory.used')
+        self.mem_total = gpu.pop('memory.total')
+        self.users = {sys.intern(k): v for (k, v) in gpu.pop('users').items()}
+        self.extra = gpu or None
+
+
+class HostRecord(CompactRecord):
+    '''
+    Compact record of a host, with a GpuRecord per GPU
+    '''
+    __slots__ = ('hostname', 'query_time', 'gpus', 'cpu_percent', 'loadavg',
+                 'vm_total_M', 'vm_available_M')
+    FIELDS = {k: k for k in __slots__}
+
+    def __init__(self, data: dict):
+        data = dict(data)
+        self.hostname = sys.intern(data.pop('hostname'))
+        self.gpus = tuple(GpuRecord(gpu) for gpu in data.pop('gpus'))
+        self.loadavg = tuple(data.pop('loadavg', ()))
+        for k in ('query_time', 'cpu_percent', 'vm_total_M', 'vm_available_M'):
+            setattr(self, k, data.pop(k, None))
+        self.extra = data or None
+
+    def as_dict(self) -> dict:
+        data = super().as_dict()
+        data['gpus'] = [gpu.as_dict() for gpu in self.gpus]
+        data['loadavg'] = list(self.loadavg)
+        return data
+
+
 # global dict storing the latest record from each client
 __G__ = dict()
 # global dict storing the timestamp of the latest record
 __G_lastsync__ = dict()
+# global counter bumped whenever any client submits new data
+__G_generation__ = 0
+# global dict storing the last sequence number of delta-encoding clients
+__G_seq__ = dict()
+# global dict storing the generation at which each record was stored
+__G_hostgen__ = dict()
+# backend of the records shared by the worker processes, see state.py
+__STATE__ = make_state(os.environ.get('GPUWATCH_STATE', 'memory'))
+# held while the records and the fleet aggregates are updated or read,
+# since the threaded dev server applies submissions concurrently
+__STATE_LOCK__ = threading.RLock()
+# render cache: hostname -> (record, html before sync badge, html after it)
+__CACHE_HOST__ = dict()
+# render cache: (generation, navbar head, per-client items, navbar tail)
+__CACHE_NAVBAR__ = (-1, '', [], '')
+# time-series history of all the samples, disabled with an empty path
+__HISTORY_DB__ = os.environ.get('GPUWATCH_HISTORY_DB', '__history__.db')
+__HISTORY__ = HistoryStore(__HISTORY_DB__) if __HISTORY_DB__ else None
+# recent per-GPU samples kept in memory for window statistics, only with
+# the memory backend, see recent_stats()
+__RECENT__ = RecentHistory(size=720)
+# global event log pushed to /events subscribers
+__EVENTS__ = EventLog()
+# render cache: (generation, JSON snapshot of the whole state)
+__CACHE_STATE__ = (-1, '')
+# render cache: hostname -> (record, lastsync, metric family -> exposition lines)
+__CACHE_METRICS_HOST__ = dict()
+# render cache: (generation, encoded exposition of all the hosts)
+__CACHE_METRICS__ = (-1, b'')
+# fleet aggregates (GPU model -> count, user -> GPU tally), kept by submit()
+__AGG__ = {'all': Counter(), 'free': Counter(), 'used': Counter(),
+           'users': Counter()}
+# fleet aggregates: GPU model -> hostname -> number of free GPUs
+__AGG_FIND__ = defaultdict(dict)
+# fleet aggregates: hostname -> contribution of its latest record
+__AGG_HOST__ = dict()
+# free GPU index: GPU model -> sorted [(-free memory, hostname, index, model)]
+__FREE_INDEX__ = dict()
+# full garbage collections are only run above this resident set size.
+# The records are acyclic and freed by reference counting anyway.
+__GC_RSS_MB__ = int(os.environ.get('GPUWATCH_GC_RSS_MB', 256))
+# and checked at most this often, in seconds
+__GC_INTERVAL__ = 10.0
+__GC_LAST__ = 0.0
+# fewer young collections while decoding the submissions
+gc.set_threshold(10000, 20, 20)
+# latency histograms and counters of this process, see /api/internal/stats
+__STATS__ = Instruments()
+__STATS__.install_gc_callback()
+# compressed bodies: (path, generation, encoding) -> compressed body, LRU
+__CACHE_COMPRESSED__ = OrderedDict()
+__CACHE_COMPRESSED_MAX__ = 128
+__CACHE_COMPRESSED_LOCK__ = threading.Lock()
+# responses compressed by compress_response()
+__COMPRESSIBLE__ = ('text/html', 'application/json', 'text/plain')
+# endpoints whose bodies only depend on the path and the generation, their
+# compressed bodies are cached
+__PER_GENERATION__ = {'root', 'one_client', 'api_state', 'gen_client_user_leaderboard'}
+# the favicon, served from memory
+try:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'static', 'favicon.ico'), 'rb') as f:
+        __FAVICON__ = f.read()
+except OSError:
+    __FAVICON__ = None
+# token of the admin endpoints, which are disabled if empty
+__ADMIN_TOKEN__ = os.environ.get('GPUWATCH_ADMIN_TOKEN', '')
+__PROFILE_LOCK__ = threading.Lock()
 
 
-def html_per_gpu(gpu) -> str:
+def html_per_gpu(gpu, recent=None) -> str:
     memory_percent = int(100 * (gpu['memory.used'] / float(gpu['memory.total'])))
     if memory_percent <= 25:
         memory_color = 'bg-success'
@@ -161,6 +408,8 @@ def html_per_gpu(gpu) -> str:
 <small><b>Users:</b> {users}</small>
 </div>
 
+{recent}
+
 </div><!-- hstack -->
 
 </li>'''.format(
@@ -173,238 +422,940 @@ def html_per_gpu(gpu) -> str:
         memory_used=gpu['memory.used'],
         memory_total=gpu['memory.total'],
         users=users,
+        recent=html_recent(recent),
         )
     return html
 
-def html_per_host(host, lastsync) -> str:
-    # calculate the time since the last sync
-    since_last_sync = int(time.time() - lastsync)
-    if since_last_sync > 60:
-        since_last_sync = f'''<span class="badge bg-danger">Last Sync: {since_last_sync} (ERROR: Client Disconnected)</span>'''
-    else:
-        since_last_sync = f'''<span class="badge bg-success">Last Sync: {since_last_sync} (OK)</span>'''
+
+def html_recent(recent) -> str:
+    '''
+    render the window statistics of the last hour of a GPU
+    '''
+    if recent is None or recent['n'] < 2:
+        return ''
+    return f'''<div class="ms-auto"><small class="text-body-secondary">1h: avg {recent['util_mean']:.0f}% p95 {recent['util_p95']}% idle {100*recent['idle_fraction']:.0f}%</small></div>'''
+
+def html_last_sync(lastsync) -> str:
+    '''
+    render the "Last Sync" badge, the only live part of a host card. It
+    shows the time of the sync, and tick_lastsync() turns it into the age,
+    so that the page only changes with the records.
+    '''
+    stamp = time.strftime('%H:%M:%S', time.localtime(lastsync))
+    return f'''<span class="badge bg-secondary" data-lastsync="{lastsync}">Last Sync: {stamp}</span>'''
+
+
+@__STATS__.phase('render.host')
+def html_per_host_parts(host) -> tuple:
+    '''
+    render a host card, split around the "Last Sync" badge
+    '''
     # format sysstat
     mem_percent = int(100.0 * host['vm_available_M'] / host['vm_total_M'])
     sysstat = f'''CPU: {host['cpu_percent']:.1f}% (LoadAvg: {host['loadavg'][0]:.1f}) RAM: {mem_percent}% ({int(host['vm_available_M'])} / {int(host['vm_total_M'])})'''
     # render html
     html_gpus = []
     html_gpus.append('''
+<div id="host-{hostname}">
 <div class="card">
 <div class="card-header">
     {hostname}
     <span>| {sysstat}</span>
-    <span class="float-end">{since_last_sync}</span>
+    <span class="float-end">@SINCE_LAST_SYNC@</span>
 </div>
 <ul class="list-group list-group-flush">
 '''.format(
     hostname=host['hostname'],
     sysstat=sysstat,
-    since_last_sync=since_last_sync,
 ))
     for gpu in host['gpus']:
-        html_gpus.append(html_per_gpu(gpu))
-    #for gpu in host['gpus']:
-    #    html_gpus.append(html_per_gpu(gpu))
-    #for gpu in host['gpus']:
-    #    html_gpus.append(html_per_gpu(gpu))
-    #for gpu in host['gpus']:
-    #    html_gpus.append(html_per_gpu(gpu))
+        html_gpus.append(html_per_gpu(
+            gpu, recent_stats(host['hostname'], gpu['index'], 3600)))
     html_gpus.append('''
 </ul>
 </div><!-- card -->
 <br>
+</div>
 ''')
-    return '\n'.join(str(x) for x in html_gpus)
+    head, _, tail = '\n'.join(str(x) for x in html_gpus).partition('@SINCE_LAST_SYNC@')
+    return head, tail
+
+
+def cached_html_per_host(hostname: str) -> str:
+    '''
+    render a host card from the cache. The cached fragment is only
+    re-rendered when submit() has stored a new record for this host.
+    '''
+    host = __G__[hostname]
+    cached = __CACHE_HOST__.get(hostname)
+    if cached is None or cached[0] is not host:
+        cached = (host, *html_per_host_parts(host))
+        __CACHE_HOST__[hostname] = cached
+    return cached[1] + html_last_sync(__G_lastsync__[hostname]) + cached[2]
 
 
+@__STATS__.phase('render.client_list')
 def gen_client_list() -> str:
     '''
     generate the client list for the navbar
     '''
+    _, _, items, _ = cached_navbar()
     lines = []
     lines.append('''<li><a class="dropdown-item" href="/"><b>All</b> (default)</a></li>''')
     lines.append('''<li><hr class="dropdown-divider"></li>''')
-    for client in sorted(__G__.keys()):
-        lastsync = int(time.time() - __G_lastsync__[client])
-        if lastsync <= 60:
-            lines.append(f'<li><a class="dropdown-item" href="/{client}"><b>{client}</b>: Synced <span class="badge text-bg-success">{lastsync}</span>s ago</a></li>')
-        else:
-            lines.append(f'<li><a class="dropdown-item" href="/{client}"><b>{client}</b>: Synced <span class="badge text-bg-danger">{lastsync}</span>s ago</a></li>')
+    for (client, item) in items:
+        lines.append(item + html_client_sync(client, __G_lastsync__[client]) + '</a></li>')
     lines.append('''<li><hr class="dropdown-divider"></li>''')
     lines.append('''<li><a class="dropdown-item" href="#"><b>Flex</b>: &lt;URL&gt;/client1,client2,...</a></li>''')
     return '\n'.join(lines)
 
 
-def __is_low_util(gpu) -> bool:
+def html_client_sync(client: str, lastsync) -> str:
     '''
-    helper function to determine whether this GPU is free or not
+    render the live sync age of a client in the navbar, filled in by
+    tick_lastsync()
+    '''
+    attrs = f'data-kind="client" data-hostname="{client}" data-lastsync="{lastsync}"'
+    return f'Synced <span class="badge text-bg-secondary" {attrs}>-</span>s ago'
+
+
+def __get_users(gpu) -> set:
+    '''
+    helper function to get the users of this GPU, except for ignored ones
     '''
     __IGNORED_USERS__ = ['gdm3', 'gdm']
     users = set(gpu['users'].keys())
     for ignored in __IGNORED_USERS__:
         if ignored in users:
             users -= {ignored,}
-    return len(users) == 0 \
-        or gpu['utilization.gpu'] <= 2 \
-        and gpu['memory.used']/gpu['memory.total'] < 0.02
+    return users
+
 
+def recent_stats(hostname: str, index: int, seconds: float) -> dict:
+    '''
+    window statistics of a GPU from the in-memory ring, or None. With a
+    shared backend, a worker catching up only gets the latest record of
+    each host, so the rings would differ between the workers, and so would
+    the pages and the free GPU counts. They are not used then.
+    '''
+    if __STATE__.shared:
+        return None
+    return __RECENT__.stats(hostname, index, seconds)
+
+
+def __is_low_util(gpu, recent=None) -> bool:
+    '''
+    helper function to determine whether this GPU is free or not.
+    If given, recent() returns the recent window statistics, which must
+    agree, so that a busy GPU is not reported free because it was sampled
+    during a short stall. The same goes for the window maximum sent by
+    `client.py --adaptive`. recent() is costly, and only called for the
+    GPUs in use that look idle.
+    '''
+    users = __get_users(gpu)
+    if len(users) == 0:
+        return True
+    if gpu['utilization.gpu'] > 2 or gpu.get('utilization.gpu.max', 0) > 2 \
+            or gpu['memory.used']/gpu['memory.total'] >= 0.02:
+        return False
+    stats = None if recent is None else recent()
+    return stats is None or stats['util_p95'] <= 2
 
+
+def host_aggregates(host) -> dict:
+    '''
+    compute the contribution of one host to the fleet aggregates
+    '''
+    contrib = {key: Counter() for key in __AGG__.keys()}
+    contrib['free_gpus'] = []
+    for gpu in host['gpus']:
+        name = gpu['name']
+        contrib['all'][name] += 1
+        if __is_low_util(gpu, lambda: recent_stats(host['hostname'], gpu['index'], 120)):
+            contrib['free'][name] += 1
+            contrib['free_gpus'].append((gpu['memory.used'] - gpu['memory.total'],
+                                         host['hostname'], gpu['index'], name))
+        else:
+            contrib['used'][name] += 1
+        for user in __get_users(gpu):
+            contrib['users'][user] += 1
+    return contrib
+
+
+def update_aggregates(hostname: str, host) -> None:
+    '''
+    replace the previous contribution of this host to the fleet aggregates
+    with the contribution of its new record
+    '''
+    old = __AGG_HOST__.get(hostname)
+    new = host_aggregates(host)
+    for (key, total) in __AGG__.items():
+        if old is not None:
+            total.subtract(old[key])
+        total.update(new[key])
+        for k in [k for (k, v) in total.items() if v <= 0]:
+            del total[k]
+    if old is not None:
+        for name in old['free'].keys():
+            __AGG_FIND__[name].pop(hostname, None)
+            if not __AGG_FIND__[name]:
+                del __AGG_FIND__[name]
+    for (name, number) in new['free'].items():
+        __AGG_FIND__[name][hostname] = number
+    if old is not None:
+        for entry in old['free_gpus']:
+            entries = __FREE_INDEX__.get(entry[3], [])
+            i = bisect.bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+            else:
+                console.log(f'free index: missing entry {entry}')
+            if not entries:
+                __FREE_INDEX__.pop(entry[3], None)
+    for entry in new['free_gpus']:
+        bisect.insort(__FREE_INDEX__.setdefault(entry[3], []), entry)
+    __AGG_HOST__[hostname] = new
+
+
+@__STATS__.phase('render.statistics')
 def gen_client_statistics() -> str:
     '''
     generate the client statistics for the navbar
     '''
-    gpu_all, gpu_free = defaultdict(int), defaultdict(int)
-    gpu_used = defaultdict(int)
-    for client in __G__.keys():
-        for gpu in __G__[client]['gpus']:
-            index = gpu['index']
-            name = gpu['name']
-            gpu_all[name] += 1
-            if __is_low_util(gpu):
-                gpu_free[name] += 1
-            else:
-                gpu_used[name] += 1
+    gpu_all, gpu_free = __AGG__['all'], __AGG__['free']
+    gpu_used = __AGG__['used']
     lines = []
     total_all = sum(gpu_all.values())
     lines.append(f'<li><a class="dropdown-item" href="#"><b>Total: {total_all}</b></a></li>')
-    for (k, v) in gpu_all.items():
+    for (k, v) in sorted(gpu_all.items()):
         lines.append(f'<li><a class="dropdown-item" href="#">{k}: <span class="badge text-bg-secondary">{v}</span></a></li>')
     lines.append('''<li><hr class="dropdown-divider"></li>''')
     #
     total_free = sum(gpu_free.values())
     lines.append(f'<li><a class="dropdown-item" href="#"><b>Free: {total_free}</b></a></li>')
-    for (k, v) in gpu_free.items():
+    for (k, v) in sorted(gpu_free.items()):
         lines.append(f'<li><a class="dropdown-item" href="#">{k}: <span class="badge text-bg-success">{v}</span></a></li>')
     lines.append('''<li><hr class="dropdown-divider"></li>''')
     #
     total_used = sum(gpu_used.values())
     lines.append(f'<li><a class="dropdown-item" href="#"><b>Used: {total_used}</b></a></li>')
-    for (k, v) in gpu_used.items():
+    for (k, v) in sorted(gpu_used.items()):
         lines.append(f'<li><a class="dropdown-item" href="#">{k}: <span class="badge text-bg-danger">{v}</span></a></li>')
     return '\n'.join(lines)
 
 
+@__STATS__.phase('render.find')
 def gen_client_find() -> str:
     '''
     find free GPUs from all clients
     '''
-    finder = defaultdict(lambda: defaultdict(int))
-    for client in __G__.keys():
-        for gpu in __G__[client]['gpus']:
-            name = gpu['name']
-            if __is_low_util(gpu):
-                finder[name][client] += 1
+    finder = __AGG_FIND__
     lines = []
-    for i, name in enumerate(finder.keys()):
+    for i, name in enumerate(sorted(finder.keys())):
         lines.append(f'<li><a class="dropdown-item" href="#"><b>{name}</b></a></li>')
-        for (client, number) in sorted(finder[name].items(), key=lambda x: -x[1]):
+        for (client, number) in sorted(finder[name].items(), key=lambda x: (-x[1], x[0])):
             lines.append(f'<li><a class="dropdown-item" href="/{client}">{client}: <span class="badge text-bg-success">{number}</span></a></li>')
         if i < len(finder.keys()) - 1:
             lines.append('''<li><hr class="dropdown-divider"></li>''')
     return '\n'.join(lines)
 
 
+@app.route('/api/free')
+def api_free():
+    '''
+    free GPUs ranked by free memory, for job launchers, e.g.
+    /api/free?model=A100&count=2&min_mem=40000&same_host=1
+    The hosts that did not submit in the last max_age seconds are skipped.
+    '''
+    model = request.args.get('model', default='', type=str).lower()
+    count = request.args.get('count', default=1, type=int)
+    min_mem = request.args.get('min_mem', default=0, type=int)
+    max_age = request.args.get('max_age', default=60.0, type=float)
+    same_host = request.args.get('same_host', default=0, type=int)
+    if count < 1 or min_mem < 0:
+        return 'count must be positive and min_mem not negative', 400
+    now = time.time()
+    candidates, per_host = [], defaultdict(list)
+    with __STATE_LOCK__:
+        ranked = heapq.merge(*(entries for (name, entries) in __FREE_INDEX__.items()
+                               if model in name.lower()))
+        for (free, hostname, index, name) in ranked:
+            if -free < min_mem:
+                break
+            age = now - __G_lastsync__[hostname]
+            if age > max_age:
+                continue
+            gpu = {'host': hostname, 'gpu': index, 'model': name,
+                   'memory.free': -free, 'age': age}
+            if same_host:
+                per_host[hostname].append(gpu)
+                if len(per_host[hostname]) == count:
+                    candidates = per_host[hostname]
+                    break
+            else:
+                candidates.append(gpu)
+                if len(candidates) == count:
+                    break
+    return {'candidates': candidates, 'satisfied': len(candidates) == count}
+
+
+# Prometheus metric families of /metrics: (name, help)
+METRICS = (
+    ('gpuwatch_gpu_utilization_percent', 'GPU utilization.'),
+    ('gpuwatch_gpu_utilization_max_percent', 'Maximum GPU utilization since the previous submission.'),
+    ('gpuwatch_gpu_memory_used_bytes', 'GPU memory used.'),
+    ('gpuwatch_gpu_memory_total_bytes', 'GPU memory total.'),
+    ('gpuwatch_gpu_user_memory_bytes', 'GPU memory used by each user.'),
+    ('gpuwatch_host_cpu_percent', 'CPU utilization.'),
+    ('gpuwatch_host_loadavg', 'Load average.'),
+    ('gpuwatch_host_memory_total_bytes', 'RAM total.'),
+    ('gpuwatch_host_memory_available_bytes', 'RAM available.'),
+    ('gpuwatch_host_last_sync_timestamp_seconds', 'Time of the last submission.'),
+    )
+
+
+def metric_labels(**labels) -> str:
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for (k, v) in labels.items()) + '}'
+
+
+def metrics_per_host(host, lastsync: float) -> dict:
+    '''
+    the exposition lines of one host, per metric family
+    '''
+    hostname = host['hostname']
+    lines = defaultdict(list)
+    for gpu in host['gpus']:
+        labels = metric_labels(host=hostname, gpu=gpu['index'], model=gpu['name'])
+        lines['gpuwatch_gpu_utilization_percent'].append(f'{labels} {gpu["utilization.gpu"]}')
+        if gpu.get('utilization.gpu.max') is not None:
+            lines['gpuwatch_gpu_utilization_max_percent'].append(
+                f'{labels} {gpu["utilization.gpu.max"]}')
+        lines['gpuwatch_gpu_memory_used_bytes'].append(f'{labels} {gpu["memory.used"] * 2**20}')
+        lines['gpuwatch_gpu_memory_total_bytes'].append(f'{labels} {gpu["memory.total"] * 2**20}')
+        for (user, used) in gpu['users'].items():
+            labels = metric_labels(host=hostname, gpu=gpu['index'], user=user)
+            lines['gpuwatch_gpu_user_memory_bytes'].append(f'{labels} {used * 2**20}')
+    labels = metric_labels(host=hostname)
+    if host['cpu_percent'] is not None:
+        lines['gpuwatch_host_cpu_percent'].append(f'{labels} {host["cpu_percent"]}')
+    for (period, load) in zip(('1m', '5m', '15m'), host['loadavg']):
+        lines['gpuwatch_host_loadavg'].append(f'{metric_labels(host=hostname, period=period)} {load}')
+    if host['vm_total_M'] is not None:
+        lines['gpuwatch_host_memory_total_bytes'].append(f'{labels} {host["vm_total_M"] * 2**20}')
+    if host['vm_available_M'] is not None:
+        lines['gpuwatch_host_memory_available_bytes'].append(f'{labels} {host["vm_available_M"] * 2**20}')
+    lines['gpuwatch_host_last_sync_timestamp_seconds'].append(f'{labels} {lastsync}')
+    return lines
+
+
+@__STATS__.phase('render.metrics')
+def metrics_exposition() -> bytes:
+    '''
+    the exposition text of all the hosts, built once per generation from
+    the per-host lines, which are only rebuilt for the new records
+    '''
+    global __CACHE_METRICS__
+    generation = __G_generation__
+    if __CACHE_METRICS__[0] == generation:
+        return __CACHE_METRICS__[1]
+    hosts = []
+    for hostname in sorted(__G__.keys()):
+        host, lastsync = __G__[hostname], __G_lastsync__[hostname]
+        cached = __CACHE_METRICS_HOST__.get(hostname)
+        if cached is None or cached[0] is not host or cached[1] != lastsync:
+            cached = (host, lastsync, metrics_per_host(host, lastsync))
+            __CACHE_METRICS_HOST__[hostname] = cached
+        hosts.append(cached[2])
+    text = []
+    for (name, help) in METRICS:
+        text.append(f'# HELP {name} {help}\n# TYPE {name} gauge\n')
+        text.extend(f'{name}{line}\n' for lines in hosts for line in lines.get(name, ()))
+    text.append(f'# HELP gpuwatch_hosts Number of hosts.\n# TYPE gpuwatch_hosts gauge\n'
+                f'gpuwatch_hosts {len(hosts)}\n')
+    text = ''.join(text).encode()
+    __CACHE_METRICS__ = (generation, text)
+    return text
+
+
+@app.route('/metrics')
+def metrics():
+    '''
+    Prometheus exposition of the latest records. Only the last sync ages
+    are computed for each scrape, the rest is cached per generation.
+    '''
+    now = time.time()
+    age = ['# HELP gpuwatch_host_last_sync_age_seconds Seconds since the last submission.\n'
+           '# TYPE gpuwatch_host_last_sync_age_seconds gauge\n']
+    age.extend(f'gpuwatch_host_last_sync_age_seconds{metric_labels(host=h)} {now - t:.3f}\n'
+               for (h, t) in sorted(__G_lastsync__.items()))
+    age = ''.join(age).encode()
+    exposition = metrics_exposition()
+    response = app.response_class(mimetype='text/plain; version=0.0.4')
+    response.vary.add('Accept-Encoding')
+    if accepted_encoding(('gzip',)) is None:
+        response.set_data(exposition + age)
+    else:
+        # concatenated gzip members decompress to the concatenated bodies
+        response.set_data(compressed_body(('/metrics', g.generation), exposition, 'gzip')
+                          + compress(age, 'gzip'))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
 @app.route('/leaderboard')
 def gen_client_user_leaderboard() -> str:
     '''
     rank users across all clients based on occupied GPU tally
     '''
-    def __get_users(gpu):
-        __IGNORED_USERS__ = ['gdm3', 'gdm']
-        users = set(gpu['users'].keys())
-        for ignored in __IGNORED_USERS__:
-            if ignored in users:
-                users -= {ignored,}
-        return users
-    board = defaultdict(int)
-    for client in __G__.keys():
-        for gpu in __G__[client]['gpus']:
-            users = __get_users(gpu)
-            for user in users:
-                board[user] += 1
+    with __STATE_LOCK__:
+        board = sorted(__AGG__['users'].items(), key=lambda x: (-x[1], x[0]))
     lines = []
-    for name, occupy in sorted(board.items(), key=lambda x: -x[1]):
+    for name, occupy in board:
         lines.append(f'<li><a class="dropdown-item" href="#">{name}: <b>{occupy}</b></a></li>')
     return '\n'.join(lines)
 
 
+@__STATS__.phase('render.navbar')
+def cached_navbar() -> tuple:
+    '''
+    return the navbar split around the client list, recomputed once per
+    submit generation. The client list items are cached without their
+    sync age badges, which gen_client_list() patches in for each request.
+    '''
+    global __CACHE_NAVBAR__
+    generation = __G_generation__
+    if __CACHE_NAVBAR__[0] != generation:
+        with __STATE_LOCK__:
+            header = HEADER.replace('@STAT_CLIENTS@', gen_client_statistics())
+            header = header.replace('@FIND_CLIENTS@', gen_client_find())
+        head, _, tail = header.partition('@NAV_CLIENTS@')
+        items = [(client, f'<li><a class="dropdown-item" href="/{client}"><b>{client}</b>: ')
+                 for client in sorted(__G__.keys())]
+        __CACHE_NAVBAR__ = (generation, head, items, tail)
+    return __CACHE_NAVBAR__
+
+
+def render_header() -> str:
+    _, head, _, tail = cached_navbar()
+    return head + gen_client_list() + tail
+
+
+def html_missing_client(client: str) -> str:
+    return f'''
+            <div class="alert alert-danger" role="alert">
+              The specified client "{client}" does not exist.
+              Check your URL and try again!
+              <a href="/">Click here to reset.</a>
+            </div>
+            '''
+
+
 @app.route('/')
 def root():
-    body = '''<br><div class='container'>'''
+    body = ['''<br><div class='container'>''']
     for hostname in sorted(__G__.keys()):
-        body += html_per_host(__G__[hostname], __G_lastsync__[hostname])
-    body += '''</div>'''
-    header = HEADER.replace('@NAV_CLIENTS@', gen_client_list())
-    header = header.replace('@STAT_CLIENTS@', gen_client_statistics())
-    header = header.replace('@FIND_CLIENTS@', gen_client_find())
-    tail = TAIL
-    return header + body + tail
+        body.append(cached_html_per_host(hostname))
+    body.append('''</div>''')
+    return render_header() + ''.join(body) + TAIL
 
 
 @app.route('/<string:client>')
 def one_client(client: str):
-    body = '''<br><div class='container'>'''
-    if ',' in client:
-        clients = client.split(',')
-        for client in clients:
-            if client in __G__:
-                body += html_per_host(__G__[client], __G_lastsync__[client])
-            else:
-                body += f'''
-                <div class="alert alert-danger" role="alert">
-                  The specified client "{client}" does not exist.
-                  Check your URL and try again!
-                  <a href="/">Click here to reset.</a>
-                </div>
-                '''
-    else:
+    body = ['''<br><div class='container'>''']
+    for client in client.split(','):
         if client in __G__:
-            body += html_per_host(__G__[client], __G_lastsync__[client])
+            body.append(cached_html_per_host(client))
         else:
-            body += f'''
-            <div class="alert alert-danger" role="alert">
-              The specified client "{client}" does not exist.
-              Check your URL and try again!
-              <a href="/">Click here to reset.</a>
-            </div>
-            '''
-    body += '''</div>'''
-    header = HEADER.replace('@NAV_CLIENTS@', gen_client_list())
-    header = header.replace('@STAT_CLIENTS@', gen_client_statistics())
-    header = header.replace('@FIND_CLIENTS@', gen_client_find())
-    tail = TAIL
-    return header + body + tail
+            body.append(html_missing_client(client))
+    body.append('''</div>''')
+    return render_header() + ''.join(body) + TAIL
+
+
+@__STATS__.phase('render.state')
+def state_json(since: int = None) -> str:
+    '''
+    serialize the records stored after the given generation (all records
+    if not specified). The full snapshot is serialized once per generation.
+    '''
+    global __CACHE_STATE__
+    generation = __G_generation__
+    if since is None and __CACHE_STATE__[0] == generation:
+        return __CACHE_STATE__[1]
+    hostnames = sorted(h for (h, g) in list(__G_hostgen__.items())
+                       if since is None or g > since)
+    state = {
+        'boot': __STATE__.boot,
+        'generation': generation,
+        'since': since,
+        'hosts': {h: __G__[h].as_dict() for h in hostnames},
+        'lastsync': {h: __G_lastsync__[h] for h in hostnames},
+        }
+    state = json.dumps(state)
+    if since is None:
+        __CACHE_STATE__ = (generation, state)
+    return state
+
+
+@app.route('/api/state')
+def api_state():
+    '''
+    JSON snapshot of all records. With ?since=<generation>&boot=<boot>,
+    only the records stored after that generation are returned. Unchanged
+    polls get 304 Not Modified through the ETag. The generation counts
+    from zero again when the boot changes, e.g. after a restart, and the
+    full snapshot is returned for a generation of another boot.
+    '''
+    since = request.args.get('since', default=None, type=int)
+    boot = request.args.get('boot', default=__STATE__.boot, type=int)
+    # the body, its ETag and the key of its compression in compress_response()
+    # must all be of the same generation
+    with __STATE_LOCK__:
+        generation = g.generation = __G_generation__
+        if since is not None and (boot != __STATE__.boot or since > generation):
+            since = None
+        etag = f'{__STATE__.boot}.{generation}' if since is None \
+            else f'{__STATE__.boot}.{generation}-{since}'
+        # compress_response() appends the encoding to the ETag
+        matched = [tag for tag in (etag, f'{etag}-{accepted_encoding()}')
+                   if tag in request.if_none_match]
+        if matched:
+            response = app.response_class(status=304)
+            etag = matched[0]
+        else:
+            response = app.response_class(state_json(since),
+                                          mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def diff_records(old, new) -> dict:
+    '''
+    return the changed fields between two records of the same host,
+    as a mapping from the field path to [previous value, new value]
+    '''
+    changes = dict()
+    for k in ('cpu_percent', 'loadavg', 'vm_total_M', 'vm_available_M'):
+        prev = None if old is None else old[k]
+        if prev != new[k]:
+            changes[k] = [prev, new[k]]
+    old_gpus = dict() if old is None else {g['index']: g for g in old['gpus']}
+    for gpu in new['gpus']:
+        prev = old_gpus.get(gpu['index'])
+        for k in ('name', 'utilization.gpu', 'memory.used', 'memory.total', 'users'):
+            if prev is None or prev[k] != gpu[k]:
+                changes[f'gpus.{gpu["index"]}.{k}'] = [None if prev is None else prev[k], gpu[k]]
+    return changes
+
+
+@__STATS__.phase('publish')
+def publish_update(hostname: str, old) -> None:
+    '''
+    push a host update to the /events subscribers
+    '''
+    update = {
+        'hostname': hostname,
+        'generation': __G_hostgen__[hostname],
+        'lastsync': __G_lastsync__[hostname],
+        'changes': diff_records(old, __G__[hostname]),
+        'html': cached_html_per_host(hostname),
+        'stat': gen_client_statistics(),
+        'find': gen_client_find(),
+        }
+    __EVENTS__.publish(json.dumps(update))
+
+
+def merge_delta(old, delta: dict) -> dict:
+    '''
+    apply the changed fields sent by a delta-encoding client to its record
+    '''
+    data = old.as_dict()
+    for (k, v) in delta.items():
+        if k != 'gpus':
+            data[k] = v
+    gpus = delta.get('gpus', dict())
+    data['gpus'] = [gpu | gpus[str(gpu['index'])] if str(gpu['index']) in gpus else gpu
+                    for gpu in data['gpus']]
+    return data
+
+
+def apply_record(hostname: str, data, lastsync: float, seq, generation: int) -> None:
+    '''
+    store a record in this process and invalidate the render caches
+    '''
+    global __G_generation__
+    data = HostRecord(data)
+    __G_seq__[hostname] = seq
+    old = __G__.get(hostname)
+    __G__[hostname] = data
+    __G_lastsync__[hostname] = lastsync
+    if not __STATE__.shared:
+        __RECENT__.append(hostname, lastsync, data)
+    update_aggregates(hostname, data)
+    __CACHE_HOST__.pop(hostname, None)
+    __G_hostgen__[hostname] = generation
+    __G_generation__ = max(__G_generation__, generation)
+    if __EVENTS__.subscribers > 0:
+        publish_update(hostname, old)
+
+
+@__STATS__.phase('sync')
+def sync_state() -> None:
+    '''
+    catch up with the records stored by the other worker processes
+    '''
+    if not __STATE__.shared or __STATE__.generation() == __G_generation__:
+        return
+    with __STATE_LOCK__:
+        for (generation, hostname, lastsync, seq, data) in __STATE__.changes(__G_generation__):
+            apply_record(hostname, data, lastsync, seq, generation)
+
+
+@__STATS__.phase('ingest')
+def ingest(data, seq: int = None) -> None:
+    '''
+    store a new record from a client
+    '''
+    hostname = data['hostname']
+    if __HISTORY__ is not None:
+        __HISTORY__.append(data)
+    # the records are applied in the order of their generations
+    with __STATE_LOCK__:
+        lastsync = time.time()
+        generation = __STATE__.put(hostname, data, lastsync, seq)
+        if __STATE__.shared:
+            sync_state()
+        else:
+            apply_record(hostname, data, lastsync, seq, generation)
+    maybe_collect()
+
+
+def rss_mb() -> float:
+    '''
+    resident set size of this process, or 0 if unknown
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def maybe_collect() -> None:
+    '''
+    run a full garbage collection when the memory grows above __GC_RSS_MB__,
+    instead of after every submission
+    '''
+    global __GC_LAST__
+    now = time.time()
+    if now - __GC_LAST__ < __GC_INTERVAL__:
+        return
+    __GC_LAST__ = now
+    if rss_mb() > __GC_RSS_MB__:
+        gc.collect()
+
+
+@app.before_request
+def before_request():
+    g.begin = time.perf_counter()
+    sync_state()
+    # the body may be newer than this, but never older
+    g.generation = __G_generation__
+
+
+@app.after_request
+def after_request(response):
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    __STATS__.observe_route(f'{request.method} {rule}', time.perf_counter() - g.begin,
+                            request.content_length or 0, response.content_length or 0)
+    return response
+
+
+def accepted_encoding(encodings: tuple = ('br', 'gzip')) -> str:
+    '''
+    the preferred content encoding of the request, or None
+    '''
+    if brotli is None:
+        encodings = tuple(e for e in encodings if e != 'br')
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    __STATS__.count(f'compressed {encoding}')
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def compressed_body(key: tuple, body: bytes, encoding: str) -> bytes:
+    '''
+    compress a response body, or reuse its compression cached under the
+    key, i.e. (path, generation)
+    '''
+    key = (*key, encoding)
+    with __CACHE_COMPRESSED_LOCK__:
+        compressed = __CACHE_COMPRESSED__.get(key)
+        if compressed is not None:
+            __CACHE_COMPRESSED__.move_to_end(key)
+    if compressed is not None:
+        __STATS__.count(f'compressed {encoding} reused')
+        return compressed
+    compressed = compress(body, encoding)
+    with __CACHE_COMPRESSED_LOCK__:
+        __CACHE_COMPRESSED__[key] = compressed
+        if len(__CACHE_COMPRESSED__) > __CACHE_COMPRESSED_MAX__:
+            __CACHE_COMPRESSED__.popitem(last=False)
+    return compressed
+
+
+@app.after_request
+def compress_response(response):
+    '''
+    serve gzip or brotli bodies. The bodies of __PER_GENERATION__ are
+    compressed once per generation, and their ETag gets the encoding.
+    '''
+    if response.status_code != 200 or response.direct_passthrough \
+            or response.is_streamed or response.mimetype not in __COMPRESSIBLE__ \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    body = response.get_data()
+    if encoding is None or len(body) < 512:
+        return response
+    if request.endpoint in __PER_GENERATION__:
+        response.set_data(compressed_body((request.full_path, g.generation), body, encoding))
+    else:
+        response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
+
+
+@app.route('/events')
+def events():
+    '''
+    Server-Sent Events stream of host updates, replacing the page refresh
+    '''
+    seq = request.headers.get('Last-Event-ID', default=__EVENTS__.seq, type=int)
+    def stream(seq):
+        __EVENTS__.subscribe(+1)
+        try:
+            yield 'retry: 3000\n\n'
+            idle = 0.0
+            while True:
+                # the updates of the other workers are only seen by polling
+                timeout = 1.0 if __STATE__.shared else 15.0
+                events = __EVENTS__.wait(seq, timeout=timeout)
+                if not events and __STATE__.shared:
+                    sync_state()
+                    events = __EVENTS__.since(seq)
+                if events is None:
+                    # too far behind, let the browser reload the page
+                    yield 'event: reload\ndata: {}\n\n'
+                    return
+                idle = 0.0 if events else idle + timeout
+                if idle >= 15.0:
+                    idle = 0.0
+                    yield ': keepalive\n\n'
+                for (seq, data) in events:
+                    yield f'id: {seq}\ndata: {data}\n\n'
+        finally:
+            __EVENTS__.subscribe(-1)
+    return app.response_class(stream(seq), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache',
+                                       'X-Accel-Buffering': 'no'})
+
+
+@__STATS__.phase('decode')
+def decode_payload(body: bytes, headers) -> object:
+    '''
+    decode the body of a POST request, which is JSON or msgpack, and
+    optionally gzip-compressed. Returns None for unsupported payloads.
+    '''
+    content_type = headers.get('Content-Type', 'application/json')
+    __STATS__.count('payload bytes', len(body))
+    if headers.get('Content-Encoding') == 'gzip':
+        body = gzip.decompress(body)
+    __STATS__.count('payload bytes decoded', len(body))
+    if content_type == 'application/json':
+        return json.loads(body)
+    elif content_type in ('application/msgpack', 'application/x-msgpack') \
+            and msgpack is not None \
+            and headers.get('X-GPUWatch-Schema', type=int) == SCHEMA_VERSION:
+        return msgpack.unpackb(body)
+    else:
+        console.log(f'unsupported POST content type')
+        return None
+
+
+def malformed_sample(data) -> bool:
+    '''
+    whether a decoded sample or delta lacks the fields ingest relies on
+    '''
+    if not isinstance(data, dict) or not isinstance(data.get('hostname'), str):
+        return True
+    if 'delta' in data:
+        return not isinstance(data['delta'], dict)
+    return not isinstance(data.get('gpus'), list)
+
+
+def apply_submit(data) -> tuple:
+    '''
+    store a decoded /submit payload, returning the response and its status
+    '''
+    if malformed_sample(data):
+        return {'error': 'malformed sample'}, 400
+    seq = data.pop('seq', None)
+    if 'delta' not in data:
+        ingest(data, seq)
+        return ({'accepted': 1} if seq is None else {'seq': seq}), 200
+    if not isinstance(seq, int):
+        return {'error': 'delta without a sequence number'}, 400
+    # delta-encoding clients only send the fields that have changed,
+    # and must send their full state again after a sequence gap
+    hostname = data['hostname']
+    with __STATE_LOCK__:
+        sync_state()
+        if hostname not in __G__ or __G_seq__.get(hostname) != seq - 1:
+            return {'resync': True}, 409
+        ingest(merge_delta(__G__[hostname], data['delta']), seq)
+    return {'seq': seq}, 200
+
+
+def apply_batch(batch) -> tuple:
+    '''
+    store a list of samples spooled by client.py. Only the latest sample
+    of each host becomes its current record, unless the record is newer,
+    e.g. when client.py has sent its newest sample ahead of the others.
+    '''
+    if not isinstance(batch, list) or any(
+            malformed_sample(data) or 'delta' in data for data in batch):
+        return {'error': 'malformed batch'}, 400
+    latest = dict()
+    for data in batch:
+        prev = latest.get(data['hostname'])
+        if prev is None or data.get('query_time', 0) >= prev.get('query_time', 0):
+            latest[data['hostname']] = data
+    for data in batch:
+        current = __G__.get(data['hostname'])
+        if data is latest[data['hostname']] and (
+                current is None or data.get('query_time', 0) >= (current['query_time'] or 0)):
+            ingest(data)
+        elif __HISTORY__ is not None:
+            __HISTORY__.append(data)
+    return {'accepted': len(batch)}, 200
 
 
 @app.route('/submit', methods=['POST'])
 def submit():
     #print(vars(request))
-    if 'Content-Type' in request.headers:
-        if request.headers['Content-Type'] != 'application/json':
-            console.log(f'unsupported POST content type')
-            return None
-    else:
-        pass
-    if 'Content-Encoding' in request.headers:
-        if request.headers['Content-Encoding'] == 'gzip':
-            data = gzip.decompress(request.data).decode()
-            data = json.loads(data)
-        else:
-            data = request.json
-    else:
-        data = request.json
-    __G__[data['hostname']] = data
-    __G_lastsync__[data['hostname']] = time.time()
-    # my cloud server does no have much memory
-    gc.collect()
-    return data
+    try:
+        data = decode_payload(request.get_data(), request.headers)
+    except Exception as e:
+        console.log(f'malformed POST body: {e!r}')
+        return 'malformed POST body', 400
+    if data is None:
+        return 'unsupported POST content type', 415
+    return apply_submit(data)
+
+
+@app.route('/submit_batch', methods=['POST'])
+def submit_batch():
+    try:
+        batch = decode_payload(request.get_data(), request.headers)
+    except Exception as e:
+        console.log(f'malformed POST body: {e!r}')
+        return 'malformed POST body', 400
+    if batch is None:
+        return 'unsupported POST content type', 415
+    return apply_batch(batch)
+
+
+@app.route('/api/history')
+def api_history():
+    '''
+    history of one GPU, e.g. /api/history?host=node1&gpu=0&span=week
+    '''
+    spans = {'hour': 3600, 'day': 3600*24, 'week': 3600*24*7,
+             'month': 3600*24*30, 'season': 3600*24*90, 'year': 3600*24*365}
+    if __HISTORY__ is None:
+        return 'history is disabled', 404
+    host = request.args.get('host', type=str)
+    gpu = request.args.get('gpu', default=0, type=int)
+    span = request.args.get('span', default='day', type=str)
+    if host not in __G__ or span not in spans:
+        return 'unknown host or span', 400
+    return __HISTORY__.query(host, gpu, spans[span])
+
+
+@app.route('/api/recent')
+def api_recent():
+    '''
+    in-memory window statistics of one GPU,
+    e.g. /api/recent?host=node1&gpu=0&seconds=600
+    '''
+    host = request.args.get('host', type=str)
+    gpu = request.args.get('gpu', default=0, type=int)
+    seconds = request.args.get('seconds', default=600, type=float)
+    if host not in __G__:
+        return 'unknown host', 400
+    if __STATE__.shared:
+        return 'window statistics need the memory backend, see /api/history', 501
+    return {
+            'stats': __RECENT__.stats(host, gpu, seconds),
+            'idle_for': __RECENT__.idle_for(host, gpu, seconds),
+            }
+
+
+@app.route('/api/internal/stats')
+def api_internal_stats():
+    '''
+    latency histograms of the routes and render phases, GC pauses, and
+    request/payload size counters of this process
+    '''
+    return __STATS__.as_dict() | {
+            'rss_mb': rss_mb(),
+            'hosts': len(__G__),
+            'generation': __G_generation__,
+            }
+
+
+@app.route('/api/internal/profile')
+def api_internal_profile():
+    '''
+    sample the stacks of the server for ?seconds= (at most 60), returned
+    in the collapsed format of flamegraph.pl. Requires the admin token,
+    in the X-GPUWatch-Token header or ?token=. Only the threads are
+    sampled: this works with the threaded dev server and with aserver.py,
+    not with the greenlets of the gevent uWSGI unit.
+    '''
+    token = request.headers.get('X-GPUWatch-Token') or request.args.get('token', '')
+    if not __ADMIN_TOKEN__ or not hmac.compare_digest(token, __ADMIN_TOKEN__):
+        return 'profiling is disabled or the token is wrong', 403
+    if not threads_sampleable():
+        return 'the requests are served by greenlets, which cannot be sampled', 501
+    seconds = min(max(request.args.get('seconds', default=10.0, type=float), 0.1), 60.0)
+    if not __PROFILE_LOCK__.acquire(blocking=False):
+        return 'a profile is already running', 409
+    try:
+        stacks = sample_stacks(seconds)
+    finally:
+        __PROFILE_LOCK__.release()
+    return app.response_class(stacks, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename=gpuwatch-{int(time.time())}.stacks'})
 
 
 @app.route('/favicon.ico')
 def favicon():
-    return send_from_directory(os.path.join(app.root_path, 'static'),
-                               'favicon.ico',
-                               mimetype='image/vnd.microsoft.icon')
+    if __FAVICON__ is None:
+        return 'no favicon', 404
+    response = app.response_class(__FAVICON__, mimetype='image/vnd.microsoft.icon')
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
 
 
 if __name__ == '__main__':
@@ -412,6 +1363,14 @@ if __name__ == '__main__':
     ag.add_argument('--debug', action='store_true', help='toggle debugging mode')
     ag.add_argument('-H', '--host', type=str, default='0.0.0.0')
     ag.add_argument('-P', '--port', type=int, default=4222)
+    ag.add_argument('--history-db', type=str, default=__HISTORY_DB__,
+                    help='history database, or empty to disable the history'
+                    ' (also set by the GPUWATCH_HISTORY_DB environment variable)')
+    ag.add_argument('--state', type=str, default=os.environ.get('GPUWATCH_STATE', 'memory'),
+                    help='records shared by the workers: memory, mmap:PATH or sqlite:PATH'
+                    ' (also set by the GPUWATCH_STATE environment variable)')
     ag = ag.parse_args()
+    __HISTORY__ = HistoryStore(ag.history_db) if ag.history_db else None
+    __STATE__ = make_state(ag.state)
 
     app.run(host=ag.host, port=ag.port, debug=ag.debug)
@@ -0,0 +1,214 @@
+'''
+Backends of the latest record of each host, shared by server.py workers.
+Copyright (C) 2023, Mo Zhou <lumin@debian.org>
+MIT/Expat License
+
+Every stored record bumps a generation counter. Each worker process keeps
+its own copy of the records for rendering, and catches up with the records
+stored by the other workers when the shared generation has moved. The
+boot of a backend identifies its counter, and changes when the counter
+starts again from zero, e.g. when the server restarts in memory mode.
+
+  memory        records only live in the process (the default)
+  mmap:PATH     append-only log in a memory-mapped file, e.g. in /dev/shm
+  sqlite:PATH   SQLite database in WAL mode
+'''
+import fcntl
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+
+class MemoryState(object):
+    '''
+    Records kept by server.py itself. Only the generation is counted here.
+    '''
+    shared = False
+
+    def __init__(self):
+        self.current = 0
+        self.boot = time.time_ns() // 1000
+
+    def put(self, hostname: str, record, lastsync: float, seq) -> int:
+        self.current += 1
+        return self.current
+
+    def generation(self) -> int:
+        return self.current
+
+    def changes(self, since: int) -> list:
+        return []
+
+
+class MmapState(object):
+    '''
+    Append-only log of records in a memory-mapped file. The header holds
+    the generation, the number of compactions (epoch), the end of the log
+    and the boot. When the log is full, it is compacted to the latest record
+    of each host. Writers take an exclusive flock, readers a shared one.
+    '''
+    shared = True
+    HEADER = struct.Struct('<QQQQ')
+    ENTRY = struct.Struct('<IQ')
+    START = 64
+
+    def __init__(self, path: str, size: int = 64 * 2**20):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            self.size = os.fstat(self.fd).st_size
+            self.mm = mmap.mmap(self.fd, self.size)
+            self.boot = self.HEADER.unpack_from(self.mm, 0)[3]
+            if self.boot == 0:
+                self.boot = time.time_ns() // 1000
+                struct.pack_into('<Q', self.mm, 24, self.boot)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        # read cursor of this process
+        self.epoch = -1
+        self.offset = self.START
+
+    def __header(self) -> tuple:
+        generation, epoch, end, _ = self.HEADER.unpack_from(self.mm, 0)
+        return generation, epoch, max(end, self.START)
+
+    def __entries(self, start: int, end: int):
+        offset = start
+        while offset < end:
+            length, generation = self.ENTRY.unpack_from(self.mm, offset)
+            body = offset + self.ENTRY.size
+            yield generation, self.mm[body:body + length]
+            offset = body + length
+
+    def __compact(self, end: int) -> int:
+        latest = dict()
+        for (generation, payload) in self.__entries(self.START, end):
+            latest[json.loads(payload)[0]] = (generation, payload)
+        offset = self.START
+        for (generation, payload) in sorted(latest.values()):
+            self.ENTRY.pack_into(self.mm, offset, len(payload), generation)
+            offset += self.ENTRY.size
+            self.mm[offset:offset + len(payload)] = payload
+            offset += len(payload)
+        return offset
+
+    def put(self, hostname: str, record, lastsync: float, seq) -> int:
+        payload = json.dumps([hostname, lastsync, seq, record]).encode()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            generation, epoch, end = self.__header()
+            if end + self.ENTRY.size + len(payload) > self.size:
+                end = self.__compact(end)
+                epoch += 1
+                if end + self.ENTRY.size + len(payload) > self.size:
+                    raise MemoryError(f'state segment of {self.size} bytes is full')
+            generation += 1
+            self.ENTRY.pack_into(self.mm, end, len(payload), generation)
+            self.mm[end + self.ENTRY.size:end + self.ENTRY.size + len(payload)] = payload
+            self.HEADER.pack_into(self.mm, 0, generation, epoch,
+                                  end + self.ENTRY.size + len(payload), self.boot)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return generation
+
+    def generation(self) -> int:
+        return self.HEADER.unpack_from(self.mm, 0)[0]
+
+    def changes(self, since: int) -> list:
+        '''
+        the (generation, hostname, lastsync, seq, record) stored after since
+        '''
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            _, epoch, end = self.__header()
+            if epoch != self.epoch:
+                # compacted by another process, read it again from the start
+                self.epoch, self.offset = epoch, self.START
+            changes = [(generation, *json.loads(payload))
+                       for (generation, payload) in self.__entries(self.offset, end)
+                       if generation > since]
+            self.offset = end
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return changes
+
+
+class SqliteState(object):
+    '''
+    Latest record of each host in a SQLite database in WAL mode.
+    '''
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        conn = self.connect()
+        conn.execute('''BEGIN IMMEDIATE''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS state (host text PRIMARY KEY,
+                     generation integer, lastsync real, seq integer, record text)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS state_generation ON state (generation)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS meta (generation integer)''')
+        conn.execute('''INSERT INTO meta SELECT 0 WHERE NOT EXISTS (SELECT * FROM meta)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS boot (boot integer)''')
+        conn.execute('''INSERT INTO boot SELECT ? WHERE NOT EXISTS (SELECT * FROM boot)''',
+                     (time.time_ns() // 1000,))
+        self.boot = conn.execute('''SELECT boot FROM boot''').fetchone()[0]
+        conn.execute('''COMMIT''')
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        one connection per thread, in autocommit mode
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=30,
+                                                     isolation_level=None)
+            conn.execute('''PRAGMA journal_mode=WAL''')
+            conn.execute('''PRAGMA synchronous=NORMAL''')
+        return conn
+
+    def put(self, hostname: str, record, lastsync: float, seq) -> int:
+        conn = self.connect()
+        conn.execute('''BEGIN IMMEDIATE''')
+        try:
+            generation = conn.execute(
+                '''UPDATE meta SET generation = generation + 1 RETURNING generation''').fetchone()[0]
+            conn.execute('''INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?)''',
+                         (hostname, generation, lastsync, seq, json.dumps(record)))
+            conn.execute('''COMMIT''')
+        except BaseException:
+            conn.execute('''ROLLBACK''')
+            raise
+        return generation
+
+    def generation(self) -> int:
+        return self.connect().execute('''SELECT generation FROM meta''').fetchone()[0]
+
+    def changes(self, since: int) -> list:
+        '''
+        the (generation, hostname, lastsync, seq, record) stored after since
+        '''
+        rows = self.connect().execute(
+            '''SELECT generation, host, lastsync, seq, record FROM state
+            WHERE generation > ? ORDER BY generation''', (since,)).fetchall()
+        return [(g, h, t, s, json.loads(r)) for (g, h, t, s, r) in rows]
+
+
+def make_state(spec: str):
+    '''
+    create a backend from memory, mmap:PATH or sqlite:PATH
+    '''
+    kind, _, path = spec.partition(':')
+    if kind == 'memory':
+        return MemoryState()
+    elif kind == 'mmap' and path:
+        return MmapState(path)
+    elif kind == 'sqlite' and path:
+        return SqliteState(path)
+    raise ValueError(f'unknown state backend {spec!r}')